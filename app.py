@@ -1,30 +1,84 @@
+import argparse
+import gzip
 import json
+import multiprocessing
 import os
 import threading
+import time
 import webbrowser
-import queue
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
 
 from flask import render_template, jsonify, request, send_file, Flask, Response, stream_with_context
+from jinja2 import TemplateError
 
 from core import CONFIG_PATH
-from core.configs import load_config, load_project_info
+from core.batch import process_file, sse, stream_events, BatchHoisting
+from core.dedup import BatchDedup
+from core.configs import load_config, load_project_info, jobs_dir, invalidate_config_snapshot
+from core.jobs import Job, JobScheduler
+from core.journal import JobJournal
 from core.logger import logger, init_from_config
-from core.util import (list_files, log_rt, get_exif, convert_heic_to_jpeg, get_template, get_template_content,
-                       save_template, list_templates)
-from processor.core import start_process
+from core.manifest import OutputManifest
+from core.memory import MemoryBudget, memory_model, image_pixels, parse_memory_budget, template_processors
+from core.metrics import metrics
+from core.preview import render_preview_jpeg, PREVIEW_LONG_EDGE
+from core.process_pool import ProcessPipelinePool
+from core.profiling import JobProfiler, SAMPLE_INTERVAL
+from core.util import (list_files, list_dir, log_rt, convert_heic_to_jpeg, get_preview_jpeg, get_template,
+                       build_template, get_template_content, save_template, list_templates, PREVIEW_SIZE)
+from core.watcher import WatchService
 
 # 加载配置
 config = load_config()
 project_info = load_project_info()
 
-# 初始化日志系统（必须在创建 Flask app 之前）
-init_from_config(config)
-
 # 创建 Flask app
 api = Flask(__name__)
 
+# 任务 trace 文件目录
+traces_dir = jobs_dir / 'traces'
+# 以下服务由 init_services 创建; 使用 spawn 的工作进程会重新导入本模块, 导入时不能创建它们
+# 任务日志
+journal: Optional[JobJournal] = None
+# 输出清单, 用于增量渲染
+manifest: Optional[OutputManifest] = None
+# process_workers > 0 时处理管道在工作进程中执行
+process_pool: Optional[ProcessPipelinePool] = None
+# 所有任务共享的调度器, 按内存预算控制同时处理的文件
+scheduler: Optional[JobScheduler] = None
+# 监听模式服务, 检测到的文件提交到 scheduler
+watch_service: Optional[WatchService] = None
+_services_lock = threading.Lock()
+
+
+def init_services():
+    """
+    初始化日志系统、任务日志、输出清单、进程池、调度器和监听模式服务, 并将上次运行遗留的 running 任务标记为中断
+
+    由启动入口调用, 以 WSGI 或 flask run 方式启动时在第一个请求之前调用; 重复调用时不做任何事
+    """
+    global journal, manifest, process_pool, scheduler, watch_service
+    with _services_lock:
+        if scheduler is not None:
+            return
+        init_from_config(config)
+        journal = JobJournal(jobs_dir / 'journal.db')
+        journal.interrupt_running_jobs()
+        manifest = OutputManifest(jobs_dir / 'manifest.db')
+        process_workers = config.getint('DEFAULT', 'process_workers', fallback=0)
+        process_pool = ProcessPipelinePool(process_workers) if process_workers > 0 else None
+        memory_budget_bytes = parse_memory_budget(config.get('DEFAULT', 'memory_budget_mb', fallback='auto'))
+        scheduler = JobScheduler(max_workers=config.getint('DEFAULT', 'max_workers', fallback=4),
+                                 memory_budget=MemoryBudget(memory_budget_bytes) if memory_budget_bytes else None)
+        watch_service = WatchService(process_watched_file, scheduler, estimate_memory=estimate_watched_file)
+
+
+@api.before_request
+def ensure_services():
+    if scheduler is None:
+        init_services()
+
 
 @api.route('/')
 def index():
@@ -70,6 +124,7 @@ def save_config():
         # 保存配置到配置文件
         with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
             config.write(f)
+        invalidate_config_snapshot()
 
         # 保存模板文件
         if 'template' in data and 'template_name' in data:
@@ -111,17 +166,65 @@ def list_input_files():
     })
 
 
+@api.route('/api/v1/file/list', methods=['GET'])
+@log_rt
+def list_dir_files():
+    """
+    按需列出单层目录
+    GET /api/v1/file/list?root=input&path=xxx&offset=0&limit=500
+
+    root 为 input 或 output, path 缺省时为根目录, 必须位于 root 对应的文件夹之内
+    """
+    root = request.args.get('root', 'input')
+    if root not in ('input', 'output'):
+        return jsonify({'error': 'root must be input or output'}), 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = max(request.args.get('limit', 500, type=int), 1)
+
+    root_folder = Path(config.get('DEFAULT', f'{root}_folder')).resolve()
+    target = Path(request.args.get('path') or root_folder).resolve()
+    if target != root_folder and root_folder not in target.parents:
+        return jsonify({'error': 'Path is outside of the root folder'}), 400
+
+    suffixes = set(config.get('DEFAULT', 'supported_file_suffixes').split(','))
+    children = list_dir(str(target), suffixes)
+
+    return gzip_jsonify({
+        'path': str(target),
+        'total': len(children),
+        'offset': offset,
+        'limit': limit,
+        'children': children[offset:offset + limit],
+    })
+
+
+def gzip_jsonify(data: dict) -> Response:
+    """客户端支持时返回 gzip 压缩的 JSON 响应"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
 @api.route('/api/v1/file', methods=['GET'])
 def get_file():
     """
     获取文件内容
     GET /api/v1/file?path=xxx
+    GET /api/v1/file?path=xxx&preview=true&size=1280  返回预览图, 优先使用内嵌预览图
     """
     file_path = request.args.get('path')
+    preview = request.args.get('preview', 'false').lower() in ('1', 'true')
+    size = request.args.get('size', PREVIEW_SIZE, type=int)
 
     # 参数验证
     if not file_path:
         return jsonify({'error': 'Missing path parameter'}), 400
+    if preview and (size is None or size <= 0):
+        return jsonify({'error': 'Invalid size'}), 400
 
     # 转为绝对路径
     abs_path = os.path.abspath(file_path)
@@ -135,8 +238,14 @@ def get_file():
         return jsonify({'error': 'Path is a directory, not a file'}), 400
 
     try:
+        if preview:
+            response = send_file(
+                get_preview_jpeg(abs_path, size),
+                mimetype='image/jpeg',
+                download_name=f"{Path(abs_path).stem}.jpg"
+            )
         # HEIC 文件转换处理
-        if Path(abs_path).suffix.lower() in {'.heic', '.heif'}:
+        elif Path(abs_path).suffix.lower() in {'.heic', '.heif'}:
             response = send_file(
                 convert_heic_to_jpeg(abs_path),
                 mimetype='image/jpeg',
@@ -158,179 +267,73 @@ def get_file():
         return jsonify({'error': str(e)}), 500
 
 
-@api.route('/api/v1/start_process', methods=['POST'])
-@log_rt
-def handle_process():
-    # 获取模板
-    template = get_template(config.get('render', 'template_name'))
+def create_job(input_files: list[str], template_name: str = None) -> str:
+    """按当前配置在任务日志中创建任务, 返回任务 id"""
+    return journal.create_job(
+        input_files,
+        template_name=template_name or config.get('render', 'template_name'),
+        input_folder=config.get('DEFAULT', 'input_folder'),
+        output_folder=config.get('DEFAULT', 'output_folder'),
+        override_existed=config.getboolean('DEFAULT', 'override_existed'),
+    )
 
-    data = request.get_json()
-    input_files = data['selectedItems']
-    input_folder = config.get('DEFAULT', 'input_folder')
-    output_folder = config.get('DEFAULT', 'output_folder')
 
-    total_count = len(input_files)
+def build_job(job_id: str, input_files: list[str], cancel_on_disconnect: bool = False, trace: bool = False) -> Job:
+    """根据任务日志中记录的模板和文件夹构建任务, 只处理 input_files, trace 为 True 时记录各阶段耗时"""
+    job_info = journal.get_job(job_id)
+    # 获取模板
+    template = get_template(job_info['template_name'])
+    job_files = [f['path'] for f in journal.get_files(job_id)]
+    processors = template_processors(get_template_content(job_info['template_name']))
+    # 多进程处理时各进程之间不共享预先计算的节点
+    hoisting = BatchHoisting(template, job_files) if process_pool is None else None
+    dedup = BatchDedup(job_files)
 
-    @log_rt
     def process_single_file(input_path):
         """处理单个文件，返回 (success, skipped, error_message)"""
-        if not os.path.exists(input_path):
-            return False, False, f"文件不存在: {input_path}"
+        return process_file(template, input_path, job_info['input_folder'], job_info['output_folder'],
+                            override_existed=job_info['override_existed'], files=job_files, manifest=manifest,
+                            pipeline=process_pool.run if process_pool is not None else None, hoisting=hoisting,
+                            dedup=dedup)
 
-        try:
-            # 获取 input_path 相对 input_folder 的位置
-            relative_path = os.path.relpath(input_path, input_folder)
-            # 基于 output_folder 组装出输出路径 output_path
-            output_path = os.path.join(output_folder, relative_path)
-
-            # 如果路径不存在, 那么递归创建文件夹
-            output_dir = os.path.dirname(output_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            # 如果 output_path 对应的文件存在, 直接跳过
-            if os.path.exists(output_path) and not config.getboolean('DEFAULT', 'override_existed'):
-                return False, True, None
-
-            _input_path = Path(input_path)
-            # 开始处理
-            context = {
-                'exif': get_exif(input_path),
-                'filename': _input_path.stem,
-                'file_dir': str(_input_path.parent.absolute()).replace('\\', '/'),
-                'file_path': str(_input_path).replace('\\', '/'),
-                'files': input_files
-            }
-            final_template = template.render(context)
-            start_process(json.loads(final_template), input_path, output_path=output_path)
-            return True, False, None
-
-        except Exception as e:
-            logger.error(f"处理文件失败 {input_path}: {e}")
-            return False, False, str(e)
+    def estimate_memory(input_path):
+        """按文件头中的尺寸和模板中的处理器估算内存峰值"""
+        return memory_model.estimate(image_pixels(input_path), processors)
+
+    return Job(job_id, input_files, process_single_file, journal, cancel_on_disconnect=cancel_on_disconnect,
+               trace_path=traces_dir / f'{job_id}.json' if trace else None, estimate_memory=estimate_memory,
+               stats=lambda: {'dedup': dedup.status()})
+
+
+def trace_requested(data: dict) -> bool:
+    """请求中的 trace 参数, 未指定时使用配置中的 trace_jobs"""
+    if 'trace' in data:
+        return bool(data['trace'])
+    return config.getboolean('DEFAULT', 'trace_jobs', fallback=False)
 
-    def generate():
-        """生成 SSE 事件流 - 使用多线程处理"""
-        # 使用线程安全的计数器和锁
-        counters = {
-            'processed': 0,
-            'success': 0,
-            'failure': 0,
-            'skipped': 0
-        }
-        counters_lock = threading.Lock()
-
-        # 结果队列，用于接收线程完成事件
-        result_queue = queue.Queue()
-
-        def worker(file_path):
-            """工作线程函数，处理单个文件并将结果放入队列"""
-            file_name = os.path.basename(file_path)
-            # 发送开始处理的事件
-            result_queue.put(('start', file_name, None))
-
-            try:
-                success, skipped, error = process_single_file(file_path)
-
-                with counters_lock:
-                    if skipped:
-                        counters['skipped'] += 1
-                        status = 'skipped'
-                    elif success:
-                        counters['success'] += 1
-                        status = 'success'
-                    else:
-                        counters['failure'] += 1
-                        status = 'failure'
-                    counters['processed'] += 1
-
-                result_queue.put(('complete', file_name, (status, error)))
-            except Exception as e:
-                with counters_lock:
-                    counters['failure'] += 1
-                    counters['processed'] += 1
-                result_queue.put(('complete', file_name, ('failure', str(e))))
-
-        def sse(event: str, data: dict):
-            """生成 SSE 格式数据"""
-            return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
-
-        # 发送开始事件
-        yield sse('start', {
-            'total': total_count,
-            'message': f'开始处理 {total_count} 个文件...'
-        })
-
-        # 使用线程池并发处理
-        max_workers = min(4, total_count)  # 最多 4 个线程
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有任务
-            futures = {executor.submit(worker, f): f for f in input_files}
-
-            # 等待任务完成并发送进度
-            for future in as_completed(futures):
-                # 从队列获取结果
-                while True:
-                    try:
-                        event_type, file_name, result = result_queue.get_nowait()
-                        if event_type == 'start':
-                            yield sse('progress', {
-                                'total': total_count,
-                                'processed': counters['processed'],
-                                'success': counters['success'],
-                                'failure': counters['failure'],
-                                'skipped': counters['skipped'],
-                                'current': file_name,
-                                'percent': round((counters['processed'] / total_count) * 100) if total_count > 0 else 0,
-                                'message': f'正在处理: {file_name}'
-                            })
-                        elif event_type == 'complete':
-                            status, error = result
-                            status_text = {'success': '完成', 'failure': '失败', 'skipped': '跳过'}[status]
-                            yield sse('progress', {
-                                'total': total_count,
-                                'processed': counters['processed'],
-                                'success': counters['success'],
-                                'failure': counters['failure'],
-                                'skipped': counters['skipped'],
-                                'current': file_name,
-                                'percent': round((counters['processed'] / total_count) * 100) if total_count > 0 else 0,
-                                'message': f'{status_text}: {file_name}'
-                            })
-                        break
-                    except queue.Empty:
-                        break
-
-        # 确保所有结果都被处理
-        while not result_queue.empty():
-            event_type, file_name, result = result_queue.get()
-            if event_type == 'complete':
-                status, error = result
-                status_text = {'success': '完成', 'failure': '失败', 'skipped': '跳过'}[status]
-                yield sse('progress', {
-                    'total': total_count,
-                    'processed': counters['processed'],
-                    'success': counters['success'],
-                    'failure': counters['failure'],
-                    'skipped': counters['skipped'],
-                    'current': file_name,
-                    'percent': round((counters['processed'] / total_count) * 100) if total_count > 0 else 0,
-                    'message': f'{status_text}: {file_name}'
-                })
-
-        # 发送完成事件
-        yield sse('complete', {
-            'total': total_count,
-            'processed': counters['processed'],
-            'success': counters['success'],
-            'failure': counters['failure'],
-            'skipped': counters['skipped'],
-            'percent': 100,
-            'message': f'处理完成! 成功: {counters["success"]}, 跳过: {counters["skipped"]}, 失败: {counters["failure"]}'
-        })
 
+def last_event_id() -> int:
+    """读取客户端重连时携带的 Last-Event-ID, 也可以通过 last_event_id 参数传入"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def watch_job(job: Job, last_id: int = 0, attached: bool = False):
+    """观察任务进度, 连接断开时通知任务, attached 表示调用方已经调用过 job.attach()"""
+    if not attached:
+        job.attach()
+    try:
+        yield from stream_events(job.progress, last_id)
+    finally:
+        job.detach()
+
+
+def event_stream_response(events) -> Response:
     return Response(
-        stream_with_context(generate()),
+        stream_with_context(events),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -340,6 +343,203 @@ def handle_process():
     )
 
 
+@api.route('/api/v1/start_process', methods=['POST'])
+@log_rt
+def handle_process():
+    data = request.get_json()
+    input_files = data['selectedItems']
+
+    # 创建任务日志, 中断后可以通过 /api/v1/jobs/<job_id>/resume 继续
+    job = build_job(create_job(input_files), input_files, cancel_on_disconnect=True, trace=trace_requested(data))
+    # 先连接再提交; 连接断开后可以通过 /api/v1/jobs/<job_id>/events 重新连接, 超时未重连则取消任务, 释放 CPU
+    job.attach()
+    scheduler.submit(job)
+    return event_stream_response(watch_job(job, attached=True))
+
+
+@api.route('/api/v1/jobs', methods=['POST'])
+@log_rt
+def submit_job_api():
+    """
+    提交异步任务, 立即返回任务 id
+    POST /api/v1/jobs {"selectedItems": [...], "template_name": "可选, 默认使用当前配置的模板", "trace": false}
+    """
+    data = request.get_json(silent=True) or {}
+    input_files = data.get('selectedItems')
+    if not isinstance(input_files, list):
+        return jsonify({'error': 'Missing selectedItems'}), 400
+    template_name = data.get('template_name')
+    if template_name and template_name not in list_templates():
+        return jsonify({'error': f'Template "{template_name}" not found'}), 404
+
+    job = scheduler.submit(build_job(create_job(input_files, template_name), input_files, trace=trace_requested(data)))
+    return jsonify({'job_id': job.id}), 202
+
+
+@api.route('/api/v1/jobs', methods=['GET'])
+def list_jobs_api():
+    """列出最近的任务"""
+    return jsonify({'jobs': journal.list_jobs(request.args.get('limit', 50, type=int))})
+
+
+@api.route('/api/v1/jobs/<job_id>', methods=['GET'])
+def get_job_api(job_id):
+    """
+    获取任务状态
+    GET /api/v1/jobs/<job_id>?files=true&state=failed  同时返回每个文件的状态
+    """
+    job_info = journal.get_job(job_id)
+    if job_info is None:
+        return jsonify({'error': f'Job "{job_id}" not found'}), 404
+    job = scheduler.get(job_id)
+    if job is not None:
+        job_info['progress'] = job.status()
+    if request.args.get('files', 'false').lower() in ('1', 'true'):
+        job_info['files'] = journal.get_files(job_id, request.args.get('state'))
+    return jsonify(job_info)
+
+
+@api.route('/api/v1/jobs/<job_id>/events', methods=['GET'])
+def job_events_api(job_id):
+    """
+    任务的 SSE 进度事件流, 多个客户端可以同时观察
+    断线重连时携带 Last-Event-ID 请求头（或 last_event_id 参数）, 从该事件之后继续
+    """
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job "{job_id}" is not active'}), 404
+    return event_stream_response(watch_job(job, last_event_id()))
+
+
+@api.route('/api/v1/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job_api(job_id):
+    """取消任务, 未开始的文件保持 queued 状态, 之后可以继续"""
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job "{job_id}" is not active'}), 404
+    job.cancel()
+    return jsonify(job.status())
+
+
+@api.route('/api/v1/jobs/<job_id>/trace', methods=['GET'])
+def job_trace_api(job_id):
+    """下载任务的 trace 文件（Chrome trace 格式, 可以在 chrome://tracing 或 ui.perfetto.dev 中打开）"""
+    trace_path = traces_dir / f'{job_id}.json'
+    if journal.get_job(job_id) is None or not trace_path.is_file():
+        return jsonify({'error': f'Trace of job "{job_id}" not found'}), 404
+    return send_file(trace_path.absolute(), mimetype='application/json', as_attachment=True,
+                     download_name=f'trace-{job_id}.json')
+
+
+@api.route('/api/v1/jobs/<job_id>/profile', methods=['POST'])
+def profile_job_api(job_id):
+    """
+    对运行中任务接下来的若干个文件进行采样分析, 结果保存在 logs/profiles 下
+    POST /api/v1/jobs/<job_id>/profile {"files": 1, "interval_ms": 5}
+    """
+    job = scheduler.get(job_id)
+    if job is None or job.done_event.is_set():
+        return jsonify({'error': f'Job "{job_id}" is not running'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        files = int(data.get('files', 1))
+        interval = float(data.get('interval_ms', SAMPLE_INTERVAL * 1000)) / 1000
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid files or interval_ms'}), 400
+    if files < 1 or interval <= 0:
+        return jsonify({'error': 'Invalid files or interval_ms'}), 400
+
+    profiler = JobProfiler(f'{job_id}-{time.strftime("%Y%m%d-%H%M%S")}', files=files, interval=interval)
+    job.attach_profiler(profiler)
+    return jsonify(profiler.status()), 202
+
+
+@api.route('/api/v1/jobs/<job_id>/profile', methods=['GET'])
+def job_profile_status_api(job_id):
+    """查看任务当前附加的采样分析器的进度"""
+    job = scheduler.get(job_id)
+    if job is None or job.profiler is None:
+        return jsonify({'error': f'Job "{job_id}" has no profiler'}), 404
+    return jsonify(job.profiler.status())
+
+
+@api.route('/api/v1/jobs/<job_id>/resume', methods=['POST'])
+@log_rt
+def resume_job_api(job_id):
+    """
+    从中断处继续任务, 只处理 queued 和 running 状态的文件
+    POST /api/v1/jobs/<job_id>/resume {"retry_failed": false, "trace": false}
+    """
+    job_info = journal.get_job(job_id)
+    if job_info is None:
+        return jsonify({'error': f'Job "{job_id}" not found'}), 404
+    # 同时到达的多个 resume 请求只有一个能将任务置为 running
+    if not journal.claim_job(job_id):
+        return jsonify({'error': f'Job "{job_id}" is still running'}), 409
+
+    data = request.get_json(silent=True) or {}
+    pending_files = journal.pending_files(job_id, retry_failed=bool(data.get('retry_failed', False)))
+    scheduler.submit(build_job(job_id, pending_files, trace=trace_requested(data)))
+    return jsonify({'job_id': job_id, 'total': len(pending_files)}), 202
+
+
+def process_watched_file(input_path: str):
+    """监听模式下处理单个文件, 文件发生了变化, 因此总是覆盖已有输出"""
+    template = get_template(config.get('render', 'template_name'))
+    return process_file(template, input_path, config.get('DEFAULT', 'input_folder'),
+                        config.get('DEFAULT', 'output_folder'), override_existed=True, manifest=manifest)
+
+
+
+def estimate_watched_file(input_path: str) -> int:
+    """按文件头中的尺寸和当前模板中的处理器估算内存峰值"""
+    processors = template_processors(get_template_content(config.get('render', 'template_name')))
+    return memory_model.estimate(image_pixels(input_path), processors)
+
+
+def start_watch():
+    watch_service.start(
+        config.get('DEFAULT', 'input_folder'),
+        set(config.get('DEFAULT', 'supported_file_suffixes').split(',')),
+        exclude=[config.get('DEFAULT', 'output_folder')],
+        debounce=config.getfloat('DEFAULT', 'watch_debounce', fallback=2.0),
+    )
+
+
+@api.route('/api/v1/watch', methods=['GET'])
+def get_watch_status():
+    """获取监听模式状态"""
+    return jsonify(watch_service.status())
+
+
+@api.route('/api/v1/watch', methods=['POST'])
+def toggle_watch():
+    """
+    开启或关闭监听模式
+    POST /api/v1/watch {"enabled": true}
+    """
+    data = request.get_json(silent=True) or {}
+    if 'enabled' not in data:
+        return jsonify({'error': 'Missing enabled'}), 400
+
+    if data['enabled']:
+        start_watch()
+    else:
+        watch_service.stop()
+    return jsonify(watch_service.status())
+
+
+@api.route('/api/v1/watch/events', methods=['GET'])
+def watch_events():
+    """监听模式的 SSE 进度事件流, 支持 Last-Event-ID 重连"""
+
+    def generate():
+        yield sse('status', watch_service.status())
+        yield from stream_events(watch_service.progress, last_event_id() or watch_service.progress.last_id, until=())
+
+    return event_stream_response(generate())
+
+
 @api.route('/api/v1/template/<template_name>', methods=['GET'])
 def get_template_api(template_name):
     """获取指定模板的内容"""
@@ -380,6 +580,54 @@ def create_template_api():
         return jsonify({'error': str(e)}), 500
 
 
+@api.route('/api/v1/preview', methods=['POST'])
+def preview_api():
+    """
+    按低分辨率渲染模板, 用于编辑模板时实时预览
+    POST /api/v1/preview {"path": "xxx", "template": "模板内容", "size": 1200, "quality": 85}
+    不传 template 时使用 template_name 对应的模板, 默认为配置中的模板
+    """
+    data = request.get_json(silent=True) or {}
+    file_path = data.get('path')
+    if not file_path:
+        return jsonify({'error': 'Missing path'}), 400
+    abs_path = os.path.abspath(file_path)
+    if not os.path.isfile(abs_path):
+        return jsonify({'error': 'File not found'}), 404
+    try:
+        size = int(data.get('size', PREVIEW_LONG_EDGE))
+        quality = int(data.get('quality', 85))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size or quality'}), 400
+    if size <= 0 or not 1 <= quality <= 100:
+        return jsonify({'error': 'Invalid size or quality'}), 400
+
+    if data.get('template') is not None:
+        try:
+            template = build_template(data['template'])
+        except TemplateError as e:
+            return jsonify({'error': f'Invalid template: {e}'}), 400
+    else:
+        template_name = data.get('template_name') or config.get('render', 'template_name')
+        try:
+            template = get_template(template_name)
+        except FileNotFoundError:
+            return jsonify({'error': f'Template "{template_name}" not found'}), 404
+
+    try:
+        response = send_file(render_preview_jpeg(template, abs_path, size, quality), mimetype='image/jpeg',
+                             download_name=f"{Path(abs_path).stem}.jpg")
+    except PermissionError:
+        return jsonify({'error': 'Permission denied'}), 403
+    except Exception as e:
+        logger.error(f"渲染预览失败 {abs_path}: {e}")
+        return jsonify({'error': str(e)}), 500
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+
 @api.route('/api/v1/templates', methods=['GET'])
 def list_templates_api():
     """获取所有可用模板列表"""
@@ -387,6 +635,22 @@ def list_templates_api():
     return jsonify({'templates': templates})
 
 
+@api.route('/api/v1/memory', methods=['GET'])
+def memory_api():
+    """内存预算的使用情况, 以及各处理器每像素内存峰值的估计"""
+    budget = scheduler.memory_budget
+    return jsonify({
+        'budget': budget.status() if budget is not None else None,
+        'processors': memory_model.status(),
+    })
+
+
+@api.route('/api/v1/metrics', methods=['GET'])
+def metrics_api():
+    """Prometheus 文本格式的处理器、各阶段耗时统计"""
+    return Response(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def start_server():
     logger.info('✅ Semi-Utils Pro 启动成功')
     logger.info(f'服务地址: http://{config.get("DEFAULT", "host")}:{config.getint("DEFAULT", "port")}')
@@ -406,11 +670,29 @@ def open_browser(delay: int = 0):
 
 
 if __name__ == '__main__':
-    # 在单独的线程中打开浏览器
-    debug = config.getboolean('DEFAULT', 'debug')
-    open_browser_later = lambda: open_browser(1)
+    # 打包后的程序启动工作进程时需要
+    multiprocessing.freeze_support()
+    init_services()
+
+    parser = argparse.ArgumentParser(description='Semi-Utils Pro')
+    parser.add_argument('--watch', action='store_true', help='启动时开启监听模式, 自动处理输入文件夹中的新照片')
+    parser.add_argument('--no-server', action='store_true', help='不启动 Web 服务, 仅运行监听模式')
+    args = parser.parse_args()
 
-    if not debug:
-        threading.Thread(target=open_browser_later).start()
+    if args.watch or args.no_server:
+        start_watch()
 
-    start_server()
+    if args.no_server:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            watch_service.stop()
+    else:
+        # 在单独的线程中打开浏览器
+        debug = config.getboolean('DEFAULT', 'debug')
+        open_browser_later = lambda: open_browser(1)
+
+        if not debug:
+            threading.Thread(target=open_browser_later).start()
+
+        start_server()
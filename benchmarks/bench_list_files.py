@@ -0,0 +1,106 @@
+"""
+list_files 性能对比: pathlib 递归版本 vs os.scandir 并发版本
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_list_files --files 100000 --repeat 3
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from core import util
+from core.util import list_files
+
+
+def list_files_pathlib(path: str, suffixes: set[str], depth: int = 0, max_depth: int = 20):
+    """重构前基于 pathlib 的实现, 仅作为性能基线"""
+    result = []
+    root = Path(path).resolve()
+    if not root.exists() or depth > max_depth:
+        return result
+    try:
+        items = list(root.iterdir())
+        dirs = sorted([i for i in items if i.is_dir()], key=lambda x: x.name.lower(), reverse=True)
+        files = sorted([i for i in items if i.is_file()], key=lambda x: (x.stat().st_mtime, x.name.lower()),
+                       reverse=True)
+        for item in dirs:
+            if item.name.startswith('.') or item.is_symlink():
+                continue
+            children = list_files_pathlib(str(item), suffixes, depth + 1, max_depth)
+            if children:
+                result.append({'label': item.name, 'value': str(item), 'children': children})
+        for item in files:
+            if item.name.startswith('.'):
+                continue
+            if item.suffix.lower() in suffixes:
+                result.append({'label': item.name, 'value': str(item), 'is_file': True})
+    except PermissionError:
+        pass
+    return result
+
+
+def make_tree(root: Path, total_files: int, files_per_dir: int = 200, fanout: int = 10) -> None:
+    """生成合成目录树: 每个目录 files_per_dir 个文件, 每层 fanout 个子目录"""
+    suffixes = ['.jpg', '.JPG', '.heic', '.png', '.txt']
+    created, dir_index = 0, 0
+    pending = [root]
+    while created < total_files:
+        current = pending.pop(0)
+        current.mkdir(parents=True, exist_ok=True)
+        for i in range(min(files_per_dir, total_files - created)):
+            (current / f"IMG_{dir_index:05d}_{i:04d}{suffixes[i % len(suffixes)]}").touch()
+            created += 1
+        pending.extend(current / f"dir_{dir_index:05d}_{j}" for j in range(fanout))
+        dir_index += 1
+
+
+def timeit(func, repeat: int, before=None) -> list[float]:
+    costs = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        func()
+        costs.append(time.perf_counter() - start)
+    return costs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100_000, help='合成文件数量')
+    parser.add_argument('--repeat', type=int, default=3, help='每个实现的运行次数')
+    parser.add_argument('--workers', type=int, default=util.SCAN_WORKERS, help='scandir 版本的线程数')
+    parser.add_argument('--root', help='在指定目录生成合成文件（例如 SMB/NFS 挂载点）, 默认使用临时目录')
+    args = parser.parse_args()
+
+    suffixes = {'.jpg', '.jpeg', '.png', '.heic'}
+    root = Path(tempfile.mkdtemp(prefix='bench_list_files_', dir=args.root))
+    try:
+        start = time.perf_counter()
+        make_tree(root, args.files)
+        print(f"生成 {args.files} 个文件, 耗时 {time.perf_counter() - start:.2f}s, 目录: {root}")
+
+        expected = list_files_pathlib(str(root), suffixes)
+        assert list_files(str(root), suffixes, max_workers=args.workers) == expected, "两种实现的结果不一致"
+
+        results = {
+            'pathlib': timeit(lambda: list_files_pathlib(str(root), suffixes), args.repeat),
+            'scandir (cold cache)': timeit(lambda: list_files(str(root), suffixes, max_workers=args.workers),
+                                           args.repeat, before=util._dir_cache.clear),
+            'scandir (warm cache)': timeit(lambda: list_files(str(root), suffixes, max_workers=args.workers),
+                                           args.repeat),
+        }
+        baseline = statistics.median(results['pathlib'])
+        for name, costs in results.items():
+            median = statistics.median(costs)
+            print(f"{name:<22} median {median * 1000:9.1f}ms  min {min(costs) * 1000:9.1f}ms  "
+                  f"speedup x{baseline / median:.2f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+处理器与模板性能基准
+
+使用合成照片（12/24/45/100 MP 的 JPEG 和 HEIC, 带合成 EXIF）运行所有已注册的处理器和 config/templates 下的所有模板,
+记录墙钟时间、CPU 时间和峰值内存, 结果保存为 JSON, 可以与之前的结果对比
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_processors
+    python -m benchmarks.bench_processors --sizes 12,24 --formats jpeg --repeat 3
+    python -m benchmarks.bench_processors --only blur,shadow --compare benchmarks/results/xxx.json
+"""
+import argparse
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import PIL
+from PIL import Image, ImageOps
+
+import processor  # noqa: F401 注册处理器和 HEIC 支持
+from core.memory import _read_status_kb, _reset_peak_rss
+from core.util import get_template, list_templates
+from processor.core import (PipelineContext, clear_plan_cache, clear_sub_pipeline_cache, get_all_processors,
+                            start_process)
+from processor.generators import clear_gradient_cache
+
+BENCH_DIR = Path(__file__).parent
+INPUTS_DIR = BENCH_DIR / '.inputs'
+RESULTS_DIR = BENCH_DIR / 'results'
+
+# 像素数 (MP) -> 3:2 或 4:3 的典型尺寸
+SIZES = {
+    12: (4032, 3024),
+    24: (6000, 4000),
+    45: (8256, 5504),
+    100: (11648, 8736),
+}
+
+SYNTHETIC_EXIF = {
+    'Make': 'NIKON CORPORATION',
+    'Model': 'NIKON Z 8',
+    'CameraModelName': 'NIKON Z 8',
+    'LensModel': 'NIKKOR Z 24-70mm f/2.8 S',
+    'FocalLength': '50.0 mm',
+    'FocalLengthIn35mmFormat': '50 mm',
+    'FNumber': '2.8',
+    'ExposureTime': '1/250',
+    'ShutterSpeed': '1/250',
+    'ISO': '100',
+    'DateTimeOriginal': '2025-01-01 12:00:00.000+08:00',
+}
+
+
+# ==================== 合成输入 ====================
+
+def synthetic_image(width: int, height: int) -> Image.Image:
+    """生成带渐变和噪声的 RGB 图像, 避免纯色图像让编码器和 trim 走捷径"""
+    rng = np.random.default_rng(42)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = (x * 0.7 + y * 0.3).astype(np.uint8)
+    pixels[..., 1] = (255 - x * 0.5 - y * 0.2).astype(np.uint8)
+    pixels[..., 2] = rng.integers(0, 64, (height, width), dtype=np.uint8) + (y * 0.5).astype(np.uint8)
+    return Image.fromarray(pixels, mode='RGB')
+
+
+def synthetic_exif() -> Image.Exif:
+    exif = Image.Exif()
+    exif[0x010F] = SYNTHETIC_EXIF['Make']
+    exif[0x0110] = SYNTHETIC_EXIF['Model']
+    exif[0x0112] = 1
+    ifd = exif.get_ifd(0x8769)
+    ifd[0x829A] = 1 / 250
+    ifd[0x829D] = 2.8
+    ifd[0x8827] = 100
+    ifd[0x9003] = '2025:01:01 12:00:00'
+    ifd[0x920A] = 50.0
+    ifd[0xA405] = 50
+    ifd[0xA434] = SYNTHETIC_EXIF['LensModel']
+    return exif
+
+
+def prepare_input(megapixels: int, fmt: str) -> Path:
+    """生成并缓存合成照片"""
+    INPUTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = INPUTS_DIR / f"synthetic_{megapixels}mp.{'jpg' if fmt == 'jpeg' else 'heic'}"
+    if not path.exists():
+        width, height = SIZES[megapixels]
+        start = time.perf_counter()
+        img = synthetic_image(width, height)
+        if fmt == 'jpeg':
+            img.save(path, quality=90, exif=synthetic_exif())
+        else:
+            img.save(path, format='HEIF', quality=90, exif=synthetic_exif())
+        print(f"生成输入 {path.name} ({width}x{height}), 耗时 {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def exif_for(img: Image.Image) -> dict:
+    """exiftool 风格的合成 EXIF, 供模板渲染和处理器使用, 不依赖 exiftool"""
+    return {**SYNTHETIC_EXIF, 'ImageWidth': str(img.width), 'ImageHeight': str(img.height)}
+
+
+def decode(path: Path) -> Image.Image:
+    """与 PipelineContext.get_buffer 相同的解码方式"""
+    img = ImageOps.exif_transpose(Image.open(path))
+    img.load()
+    return img
+
+
+# ==================== 处理器配置 ====================
+
+def _text(height: int, text: str = SYNTHETIC_EXIF['CameraModelName']) -> dict:
+    return {'processor_name': 'rich_text', 'text': text, 'height': height, 'color': '#242424'}
+
+
+def processor_cases(img: Image.Image, path: Path) -> dict:
+    """
+    每个处理器的代表性参数
+
+    Returns:
+        处理器名称 -> (配置工厂, 输入 buffer 工厂)。配置可能在处理过程中被修改, 因此每次运行都重新生成
+    """
+    w, h = img.size
+    single = lambda: [img.copy()]
+    pair = lambda: [img.copy(), img.copy()]
+    none = lambda: []
+    text_h = max(h // 30, 8)
+    return {
+        'blur': (lambda: {'blur_radius': max(h // 100, 1)}, single),
+        'resize': (lambda: {'scale': 0.5}, single),
+        'trim': (lambda: {}, single),
+        'margin': (lambda: {'left_margin': w // 20, 'right_margin': w // 20, 'bottom_margin': h // 8}, single),
+        'margin_with_ratio': (lambda: {'ratio': '1:1'}, single),
+        'watermark': (lambda: {
+            'left_top': _text(text_h),
+            'left_bottom': _text(text_h, SYNTHETIC_EXIF['LensModel']),
+            'right_top': _text(text_h, '50mm f/2.8 1/250s ISO100'),
+            'right_bottom': _text(text_h, '2025-01-01 12:00'),
+            'right_logo': str(Path('config/logos/nikon.png').absolute()),
+            'delimiter_color': '#D8D8D6',
+        }, single),
+        'watermark_with_timestamp': (lambda: {
+            'text_segments': [{'text': '2025-01-01 12:00', 'color': 'orange'}],
+        }, single),
+        'rounded_corner': (lambda: {'border_radius': max(h // 50, 1)}, single),
+        'shadow': (lambda: {'shadow_radius': max(h // 100, 1)}, single),
+        'crop': (lambda: {'width': int(w * .8), 'height': int(h * .8), 'offset': '[10, 10]'}, single),
+        'concat': (lambda: {'direction': 'vertical', 'spacing': h // 50}, pair),
+        'alignment': (lambda: {'weights': '[100,-100]'}, pair),
+        'solid_color': (lambda: {'width': w, 'height': h, 'color': 'white'}, none),
+        'gradient_color': (lambda: {'width': w, 'height': h, 'start_color': '#000000', 'end_color': '#FFFFFF',
+                                    'direction': 'radial', 'interpolate_method': 'ease_in_out'}, none),
+        'rich_text': (lambda: _text(text_h), none),
+        'multi_rich_text': (lambda: {
+            'text_segments': [{'text': 'NIKON '}, {'text': 'Z 8', 'color': 'red'}], 'height': text_h}, none),
+        'image': (lambda: {'path': str(path)}, none),
+    }
+
+
+# ==================== 计量 ====================
+
+def clear_caches():
+    """清空进程内的结果缓存, 每次运行都按未命中缓存计时, 结果与引入缓存之前的基准可比"""
+    clear_sub_pipeline_cache()
+    clear_plan_cache()
+    clear_gradient_cache()
+
+
+def measure(func, repeat: int, use_tracemalloc: bool = False, before=clear_caches) -> dict:
+    """多次运行 func, 记录墙钟时间、CPU 时间和峰值内存; 每次运行前调用 before"""
+    wall, cpu, rss, py_peak = [], [], [], []
+    for _ in range(repeat):
+        if before:
+            before()
+        rss_reset = _reset_peak_rss()
+        rss_before = _read_status_kb('VmRSS')
+        if use_tracemalloc:
+            tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall.append((time.perf_counter() - wall_start) * 1000)
+        cpu.append((time.process_time() - cpu_start) * 1000)
+        if use_tracemalloc:
+            py_peak.append(tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+            tracemalloc.stop()
+        rss_peak = _read_status_kb('VmHWM')
+        if rss_reset and rss_before is not None and rss_peak is not None:
+            rss.append(max(rss_peak - rss_before, 0) / 1024)
+
+    return {
+        'wall_ms': [round(v, 2) for v in wall],
+        'cpu_ms': [round(v, 2) for v in cpu],
+        'wall_ms_median': round(statistics.median(wall), 2),
+        'cpu_ms_median': round(statistics.median(cpu), 2),
+        'peak_rss_mb': round(max(rss), 1) if rss else None,
+        'peak_py_mb': round(max(py_peak), 1) if py_peak else None,
+    }
+
+
+# ==================== 运行 ====================
+
+def run_processor(name: str, config_factory, buffer_factory, exif: dict):
+    processor_cls = get_all_processors()[name]
+    ctx = PipelineContext({**config_factory(), 'exif': exif, 'save_buffer': False})
+    buffer = buffer_factory()
+    if buffer:
+        ctx.update_buffer(buffer).set('buffer_loaded', True)
+    processor_cls().process(ctx)
+
+
+def run_template(template, path: Path, quality: int = 90, subsampling: int = 2):
+    """解码 + 渲染模板 + 执行管道 + 编码, 不包含 exiftool"""
+    img = decode(path)
+    context = {
+        'exif': exif_for(img),
+        'filename': path.stem,
+        'file_dir': str(path.parent.absolute()).replace('\\', '/'),
+        'file_path': str(path.absolute()).replace('\\', '/'),
+        'files': [str(path)],
+    }
+    nodes = json.loads(template.render(context))
+    for node in nodes:
+        node.setdefault('exif', context['exif'])
+    result = start_process(nodes, initial_buffer=[img])
+    result.convert('RGB').save(io.BytesIO(), format='JPEG', quality=quality, subsampling=subsampling)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(current: dict, baseline_path: str):
+    """按 (类型, 名称, 输入) 对比墙钟时间中位数"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(r['kind'], r['name'], r['input']): r for r in baseline['results'] if 'wall_ms_median' in r}
+    print(f"\n与 {baseline_path} (commit {baseline['meta'].get('commit')}) 对比:")
+    print(f"{'kind':<10} {'name':<28} {'input':<12} {'before':>10} {'after':>10} {'ratio':>7}")
+    for r in current['results']:
+        before = previous.get((r['kind'], r['name'], r['input']))
+        if before is None or 'wall_ms_median' not in r:
+            continue
+        ratio = r['wall_ms_median'] / before['wall_ms_median'] if before['wall_ms_median'] else float('nan')
+        print(f"{r['kind']:<10} {r['name']:<28} {r['input']:<12} {before['wall_ms_median']:>10.1f} "
+              f"{r['wall_ms_median']:>10.1f} {ratio:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='12,24,45,100', help='输入像素数 (MP), 逗号分隔')
+    parser.add_argument('--formats', default='jpeg,heic', help='输入格式, 逗号分隔: jpeg,heic')
+    parser.add_argument('--repeat', type=int, default=3, help='每项的运行次数')
+    parser.add_argument('--only', help='只运行指定的处理器或模板, 逗号分隔')
+    parser.add_argument('--skip-processors', action='store_true', help='不运行处理器基准')
+    parser.add_argument('--skip-templates', action='store_true', help='不运行模板基准')
+    parser.add_argument('--tracemalloc', action='store_true', help='同时记录 Python 内存分配峰值（会拖慢 Python 代码）')
+    parser.add_argument('--output', help='结果文件路径, 默认 benchmarks/results/<时间>.json')
+    parser.add_argument('--compare', help='与之前的结果文件对比')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    formats = args.formats.split(',')
+    only = set(args.only.split(',')) if args.only else None
+
+    results = []
+
+    def record(kind: str, name: str, input_name: str, func):
+        try:
+            result = measure(func, args.repeat, args.tracemalloc)
+        except Exception as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+        results.append({'kind': kind, 'name': name, 'input': input_name, **result})
+        summary = result.get('error') or (f"wall {result['wall_ms_median']:9.1f}ms  cpu {result['cpu_ms_median']:9.1f}ms"
+                                          f"  rss {result['peak_rss_mb']}MB")
+        print(f"{kind:<10} {name:<28} {input_name:<12} {summary}")
+
+    for megapixels in sizes:
+        for fmt in formats:
+            path = prepare_input(megapixels, fmt)
+            input_name = f'{megapixels}MP-{fmt}'
+
+            record('decode', 'decode', input_name, lambda: decode(path))
+            img = decode(path)
+            exif = exif_for(img)
+
+            if not args.skip_processors:
+                cases = processor_cases(img, path)
+                for name in sorted(n for n in get_all_processors() if n):
+                    if only and name not in only:
+                        continue
+                    if name not in cases:
+                        results.append({'kind': 'processor', 'name': name, 'input': input_name,
+                                        'error': 'no benchmark case'})
+                        continue
+                    config_factory, buffer_factory = cases[name]
+                    record('processor', name, input_name,
+                           lambda: run_processor(name, config_factory, buffer_factory, exif))
+
+            record('encode', 'encode', input_name,
+                   lambda: img.save(io.BytesIO(), format='JPEG', quality=90, subsampling=2))
+
+            if not args.skip_templates:
+                for template_name in sorted(list_templates()):
+                    if only and template_name not in only:
+                        continue
+                    template = get_template(template_name)
+                    record('template', template_name, input_name, lambda: run_template(template, path))
+            del img
+
+    output = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'pillow': PIL.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    output_path = Path(args.output) if args.output else RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {output_path}")
+
+    if args.compare:
+        compare(output, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+批处理相关方法
+
+单个文件的渲染处理、进度事件通道, 供 Web 接口、监听模式复用
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from jinja2 import Template
+
+from core.configs import config_snapshot
+from core.dedup import BatchDedup
+from core.logger import logger
+from core.manifest import OutputManifest, text_digest
+from core.metrics import metrics, STAGE_SECONDS
+from core.tracing import span
+from core.util import get_exif, log_rt
+from processor.core import start_process, ProcessCancelled, HoistedNodes, hoist_nodes
+
+
+def get_output_path(input_path: str, input_folder: str, output_folder: str) -> str:
+    """基于 input_path 相对 input_folder 的位置, 组装出 output_folder 下的输出路径"""
+    relative_path = os.path.relpath(input_path, input_folder)
+    return os.path.join(output_folder, relative_path)
+
+
+class _ProbeExif(dict):
+    """渲染探针: 任意 exif 字段都返回同一个值"""
+
+    def __init__(self, value: str):
+        super().__init__()
+        self.value = value
+
+    def __missing__(self, key):
+        return self.value
+
+    def get(self, key, default=None):
+        return self.value
+
+
+# 两组探针的取值, 使用数字以便 vw、vh 等函数可以计算, 并且按百分比计算后仍然不同
+_PROBE_VALUES = ('4000', '6000')
+
+
+def invariant_nodes(template: Template, files: list[str]) -> tuple[list[dict], set[int]]:
+    """
+    用两组不同的探针上下文渲染模板, 找出渲染结果不随 exif、filename、file_path 变化的节点
+
+    Returns:
+        (第一组探针渲染后的处理器配置列表, 两次渲染结果相同的节点下标)
+    """
+    renders = []
+    for value in _PROBE_VALUES:
+        context = {
+            'exif': _ProbeExif(value),
+            'filename': f'probe{value}',
+            'file_dir': f'/probe{value}',
+            'file_path': f'/probe{value}/probe{value}.jpg',
+            'files': files,
+        }
+        renders.append(json.loads(template.render(context)))
+    first, second = renders
+    if len(first) != len(second):
+        return first, set()
+    return first, {idx for idx, (a, b) in enumerate(zip(first, second)) if a == b}
+
+
+class BatchHoisting:
+    """
+    批次内不变子图的提取
+
+    模板中固定文字、固定尺寸的纯色/渐变背景、固定 logo 等节点与具体文件无关, 每个批次只计算一次,
+    各文件处理时直接使用其输出。在处理第一个文件时计算
+    """
+
+    def __init__(self, template: Template, files: list[str]):
+        self.template = template
+        self.files = files
+        self._hoisted: Optional[HoistedNodes] = None
+        self._done = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[HoistedNodes]:
+        """预先计算的节点, 没有可以提取的节点或计算失败时返回 None"""
+        with self._lock:
+            if not self._done:
+                self._done = True
+                self._hoisted = self._build()
+            return self._hoisted
+
+    def _build(self) -> Optional[HoistedNodes]:
+        try:
+            data, invariant = invariant_nodes(self.template, self.files)
+            if not invariant:
+                return None
+            with span('hoist', 'pipeline'):
+                hoisted = hoist_nodes(data, invariant)
+        except Exception as e:
+            logger.warning(f"[hoist]提取批次内不变节点失败: {e}")
+            return None
+        if not hoisted:
+            return None
+        logger.info(f"[hoist]批次内不变的节点只计算一次: {', '.join(hoisted.names())}")
+        return hoisted
+
+
+def render_context(input_path: str, exif: dict, files: list[str] = None) -> dict:
+    """渲染模板时的上下文"""
+    _input_path = Path(input_path)
+    return {
+        'exif': exif,
+        'filename': _input_path.stem,
+        'file_dir': str(_input_path.parent.absolute()).replace('\\', '/'),
+        'file_path': str(_input_path).replace('\\', '/'),
+        'files': files if files is not None else [input_path]
+    }
+
+
+@log_rt
+def process_file(template: Template, input_path: str, input_folder: str, output_folder: str,
+                 override_existed: bool = False, files: list[str] = None,
+                 manifest: OutputManifest = None, pipeline: Callable = None,
+                 hoisting: BatchHoisting = None, dedup: BatchDedup = None) -> tuple[bool, bool, str | None]:
+    """
+    处理单个文件
+
+    输出文件已存在且不覆盖时: 清单中没有记录的直接跳过; 有记录的只在输入文件、渲染后的模板或保存参数变化时重新渲染
+
+    Args:
+        template: 已加载的 Jinja2 模板
+        input_path: 输入文件路径
+        input_folder: 输入文件夹
+        output_folder: 输出文件夹
+        override_existed: 输出文件已存在时是否覆盖
+        files: 本批次的全部文件, 作为模板上下文中的 files
+        manifest: 输出清单, 为 None 时不做增量判断
+        pipeline: 执行处理管道并写入输出文件的函数, 以 (模板数据, 输入路径, output_path=输出路径) 调用,
+            默认在当前线程中调用 start_process
+        hoisting: 本批次的不变节点, 只在使用默认的 start_process 时生效
+        dedup: 本批次的重复文件, 内容和渲染后的模板都相同的文件只处理一次
+
+    Returns:
+        (success, skipped, error_message)
+    """
+    if not os.path.exists(input_path):
+        return False, False, f"文件不存在: {input_path}"
+
+    try:
+        output_path = get_output_path(input_path, input_folder, output_folder)
+
+        # 如果路径不存在, 那么递归创建文件夹
+        output_dir = os.path.dirname(output_path)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        template_digest = getattr(template, 'source_digest', None)
+        entry = None
+        input_unchanged = False
+        # 同一个文件的增量判断和保存使用同一份配置
+        config = config_snapshot()
+        config_digest = text_digest(config.get('DEFAULT', 'quality'), config.get('DEFAULT', 'subsampling'))
+
+        if os.path.exists(output_path) and not override_existed:
+            entry = manifest.get(output_path) if manifest is not None else None
+            # 如果 output_path 对应的文件存在且没有清单记录, 直接跳过
+            if entry is None:
+                return False, True, None
+            input_unchanged = manifest.input_unchanged(entry, input_path) and entry['config_digest'] == config_digest
+            # 输入、模板、保存参数都没有变化, 无需读取 exif 和渲染模板
+            if input_unchanged and template_digest is not None and entry['template_digest'] == template_digest:
+                return False, True, None
+
+        # 开始处理
+        context = render_context(input_path, get_exif(input_path), files)
+        with metrics.timer(STAGE_SECONDS, stage='render'), span('render'):
+            final_template = json.loads(template.render(context))
+        render_digest = text_digest(json.dumps(final_template, sort_keys=True, ensure_ascii=False))
+        # 模板有改动, 但该文件渲染后的模板没有变化
+        if input_unchanged and entry['render_digest'] == render_digest:
+            manifest.touch_template(output_path, template_digest)
+            return False, True, None
+
+        dedup_key = dedup.key(input_path, render_digest, config_digest) if dedup is not None else None
+        source = dedup.acquire(dedup_key) if dedup_key is not None else None
+        if source is not None:
+            dedup.reuse(dedup_key, source, output_path)
+        else:
+            started = time.perf_counter()
+            rendered = False
+            try:
+                if pipeline is not None:
+                    pipeline(final_template, input_path, output_path=output_path)
+                else:
+                    hoisted = hoisting.get() if hoisting is not None else None
+                    start_process(final_template, input_path, output_path=output_path, hoisted=hoisted, config=config)
+                rendered = True
+            finally:
+                if dedup_key is not None:
+                    dedup.release(dedup_key, output_path if rendered else None, time.perf_counter() - started)
+        if manifest is not None:
+            manifest.put(output_path, input_path, template_digest, render_digest, config_digest,
+                         input_digest=dedup.digest(input_path) if dedup is not None else None)
+        return True, False, None
+
+    except ProcessCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"处理文件失败 {input_path}: {e}")
+        return False, False, str(e)
+
+
+# 进度事件流每秒最多推送的次数
+PROGRESS_MAX_RATE = 4.0
+# SSE 保持连接的心跳间隔（秒）
+KEEPALIVE_INTERVAL = 15.0
+
+
+def sse(event: str, data: dict, event_id: int = None) -> str:
+    """生成 SSE 格式数据"""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ProgressChannel:
+    """
+    进度事件通道
+
+    事件带递增 id 保存在环形缓冲区中, 订阅者按 id 拉取, 因此多个客户端可以同时观察,
+    断线重连后也可以从 Last-Event-ID 之后继续
+    """
+
+    def __init__(self, buffer_size: int = 1000):
+        self._events: deque[tuple[int, str, dict]] = deque(maxlen=buffer_size)
+        self._last_id = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event: str, data: dict) -> int:
+        """发布事件, 返回事件 id"""
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, event, data))
+            self._cond.notify_all()
+            return self._last_id
+
+    def close(self):
+        """不会再有新的事件"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def read(self, after_id: int, timeout: float) -> list[tuple[int, str, dict]]:
+        """
+        读取 id 大于 after_id 的事件, 没有新事件时最多等待 timeout 秒
+
+        after_id 早于缓冲区时只能返回缓冲区中仍保留的事件; 进度事件中的计数是累计值, 最新一条即可还原状态。
+        after_id 大于已发布的最大 id 时（如服务重启后客户端带着旧的 Last-Event-ID 重连）按 0 处理, 从缓冲区开头重放
+        """
+        with self._cond:
+            if after_id > self._last_id:
+                after_id = 0
+            self._cond.wait_for(lambda: self._last_id > after_id or self._closed, timeout)
+            return [e for e in self._events if e[0] > after_id]
+
+
+# 合并 progress 事件时不会被覆盖的文件状态, 客户端需要逐个显示这些文件及其错误信息
+_KEPT_STATUSES = ('failure', 'cancelled')
+
+
+def _coalesce(events: list[tuple[int, str, dict]]) -> list[tuple[int, str, dict]]:
+    """合并连续的 progress 事件, 只保留最后一条; 失败和取消的事件保留, 不被之后的事件覆盖"""
+    result = []
+    for item in events:
+        if (result and item[1] == 'progress' and result[-1][1] == 'progress'
+                and result[-1][2].get('status') not in _KEPT_STATUSES):
+            result[-1] = item
+        else:
+            result.append(item)
+    return result
+
+
+def stream_events(channel: ProgressChannel, last_event_id: int = 0, until: tuple[str, ...] = ('complete',),
+                  max_rate: float = PROGRESS_MAX_RATE) -> Iterator[str]:
+    """
+    将进度通道转为 SSE 事件流
+
+    事件到达时立即推送, 密集时合并, 每秒最多推送 max_rate 次
+
+    Args:
+        channel: 进度事件通道
+        last_event_id: 客户端已收到的最后一个事件 id, 断线重连时从其之后继续
+        until: 收到这些事件后结束事件流
+        max_rate: 每秒最多推送的次数
+    """
+    after_id = last_event_id
+    while True:
+        started = time.monotonic()
+        events = channel.read(after_id, timeout=KEEPALIVE_INTERVAL)
+        if not events:
+            if channel.closed:
+                return
+            # 保持连接
+            yield ': keep-alive\n\n'
+            continue
+
+        for event_id, event, data in _coalesce(events):
+            yield sse(event, data, event_id)
+        after_id = events[-1][0]
+        if any(event in until for _, event, _ in events):
+            return
+        # 限制推送频率, 期间到达的事件会在下一轮合并
+        time.sleep(max(0.0, 1 / max_rate - (time.monotonic() - started)))
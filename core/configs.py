@@ -1,5 +1,8 @@
 import configparser
+import os
+import threading
 from pathlib import Path
+from typing import Optional
 
 import tomli
 
@@ -8,6 +11,8 @@ from core import CONFIG_PATH, PROJECT_INFO
 fonts_dir = Path('config/fonts')
 logos_dir = Path('./config/logos')
 templates_dir = Path('./config/templates')
+jobs_dir = Path('./jobs')
+logs_dir = Path('./logs')
 
 def load_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser()
@@ -15,6 +20,81 @@ def load_config() -> configparser.ConfigParser:
     return config
 
 
+class ConfigSnapshot:
+    """
+    配置文件的只读快照
+
+    只提供读取方法, 可以在线程之间共享; 按原始文本序列化, 可以传给工作进程
+    """
+
+    def __init__(self, text: str, mtime_ns: int = 0):
+        self.text = text
+        self.mtime_ns = mtime_ns
+        self._parser = configparser.ConfigParser()
+        self._parser.read_string(text)
+
+    def __reduce__(self):
+        return ConfigSnapshot, (self.text, self.mtime_ns)
+
+    def has_option(self, section: str, option: str) -> bool:
+        return self._parser.has_option(section, option)
+
+    def get(self, section: str, option: str, **kwargs) -> str:
+        return self._parser.get(section, option, **kwargs)
+
+    def getint(self, section: str, option: str, **kwargs) -> int:
+        return self._parser.getint(section, option, **kwargs)
+
+    def getfloat(self, section: str, option: str, **kwargs) -> float:
+        return self._parser.getfloat(section, option, **kwargs)
+
+    def getboolean(self, section: str, option: str, **kwargs) -> bool:
+        return self._parser.getboolean(section, option, **kwargs)
+
+
+_snapshot: Optional[ConfigSnapshot] = None
+_snapshot_lock = threading.Lock()
+
+
+def _config_mtime_ns() -> int:
+    try:
+        return os.stat(CONFIG_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def config_snapshot() -> ConfigSnapshot:
+    """当前配置的快照, 只在配置文件的 mtime 变化或 invalidate_config_snapshot 之后重新读取"""
+    global _snapshot
+    mtime_ns = _config_mtime_ns()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.mtime_ns == mtime_ns:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.mtime_ns != mtime_ns:
+            try:
+                with open(CONFIG_PATH, encoding='utf-8') as f:
+                    text = f.read()
+            except OSError:
+                text = ''
+            _snapshot = ConfigSnapshot(text, mtime_ns)
+        return _snapshot
+
+
+def set_config_snapshot(snapshot: ConfigSnapshot):
+    """使用已有的快照, 如工作进程启动时由主进程传入的快照"""
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = snapshot
+
+
+def invalidate_config_snapshot():
+    """配置文件被修改后调用, 下一次 config_snapshot 重新读取; mtime 的精度可能不足以区分连续的修改"""
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
 def load_project_info():
     with open(PROJECT_INFO, "rb") as f:  # 注意：tomllib 需要以二进制模式（"rb"）打开文件
         data = tomli.load(f)
@@ -0,0 +1,162 @@
+"""
+批次内重复输入文件的识别
+
+同一张照片经常出现在多个文件夹中（如客户精选和完整拍摄）。按内容指纹对批次内的文件分组:
+先比较文件大小, 大小相同的再比较抽样数据块的摘要, 仍然相同时计算完整摘要。
+内容相同且渲染后的模板相同的文件只处理一次, 其他文件的输出通过硬链接（跨设备时复制）得到
+"""
+import os
+import shutil
+import threading
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+from core.logger import logger
+from core.manifest import file_digest, sampled_digest
+from core.memory import release_reservation, reacquire_reservation
+from processor.core import check_cancelled
+
+def _group(paths: list[str], key) -> dict:
+    """按 key 分组, 只返回包含多个文件的组, 计算 key 失败的文件忽略"""
+    groups = defaultdict(list)
+    for path in paths:
+        try:
+            groups[key(path)].append(path)
+        except OSError as e:
+            logger.warning(f"[dedup]读取文件失败 {path}: {e}")
+    return {value: group for value, group in groups.items() if len(group) > 1}
+
+
+def link_output(source: str, output_path: str) -> bool:
+    """
+    将 source 链接到 output_path, 不能创建硬链接时复制; 先写入临时文件再重命名
+
+    Returns:
+        是否为硬链接
+    """
+    directory, filename = os.path.split(output_path)
+    tmp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        try:
+            os.link(source, tmp_path)
+            linked = True
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+            linked = False
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return linked
+
+
+class _Render:
+    """一次处理: 完成后 output_path 为输出文件, 失败时为 None"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output_path: Optional[str] = None
+        self.seconds = 0.
+
+
+class BatchDedup:
+    """批次内内容相同的输入文件, 在第一次使用时对批次的全部文件分组"""
+
+    def __init__(self, files: list[str]):
+        self.files = files
+        # 文件路径 -> 内容标识, 只包含有重复的文件
+        self._content: Optional[dict[str, str]] = None
+        # (内容标识, 渲染后模板的摘要, 保存参数的摘要) -> 处理
+        self._renders: dict[tuple, _Render] = {}
+        self._lock = threading.Lock()
+        # 分组需要读取文件, 单独加锁, 期间 status 不被阻塞
+        self._build_lock = threading.Lock()
+        self.linked = 0
+        self.copied = 0
+        self.saved_seconds = 0.
+
+    def key(self, input_path: str, render_digest: str, config_digest: str) -> Optional[tuple]:
+        """输入文件在批次内有重复时返回去重的键, 否则返回 None"""
+        content = self.content_index().get(input_path)
+        return (content, render_digest, config_digest) if content is not None else None
+
+    def content_index(self) -> dict[str, str]:
+        """文件路径 -> 内容标识, 第一次调用时对批次的全部文件分组, 其他调用方等待分组完成"""
+        if self._content is None:
+            with self._build_lock:
+                if self._content is None:
+                    self._content = self._build()
+        return self._content
+
+    def digest(self, input_path: str) -> Optional[str]:
+        """分组时计算过的输入文件完整摘要, 文件在批次内没有重复时为 None"""
+        content = self.content_index().get(input_path)
+        return content.split(':', 1)[1] if content is not None else None
+
+    def _build(self) -> dict[str, str]:
+        content = {}
+        for size, same_size in _group(self.files, os.path.getsize).items():
+            for same_sample in _group(same_size, lambda path: sampled_digest(path, size)).values():
+                for digest, same_content in _group(same_sample, file_digest).items():
+                    content.update((path, f"{size}:{digest}") for path in same_content)
+        if content:
+            logger.info(f"[dedup]批次内有 {len(content)} 个文件与其他文件内容相同")
+        return content
+
+    def acquire(self, key: tuple) -> Optional[str]:
+        """
+        相同键的输出已经生成时返回其路径, 正在生成时等待; 需要当前调用方处理时返回 None, 处理后调用 release
+
+        等待期间释放当前文件占用的内存预算, 等待的文件只需要链接输出; 之前的处理失败、需要自己处理时先重新占用预算
+        """
+        released = False
+        while True:
+            with self._lock:
+                render = self._renders.get(key)
+                # 之前的处理失败时由当前调用方重新处理
+                renderable = render is None or (render.done.is_set() and render.output_path is None)
+                if renderable and not released:
+                    self._renders[key] = _Render()
+                    return None
+            if renderable:
+                # 在锁外等待预算, 之后重新检查: 期间可能已经有其他调用方开始处理
+                reacquire_reservation()
+                released = False
+                continue
+            if not render.done.is_set():
+                release_reservation()
+                released = True
+            while not render.done.wait(0.5):
+                check_cancelled()
+            if render.output_path is not None:
+                return render.output_path
+
+    def release(self, key: tuple, output_path: Optional[str], seconds: float):
+        """处理结束, 失败时 output_path 为 None"""
+        with self._lock:
+            render = self._renders[key]
+        render.output_path = output_path
+        render.seconds = seconds
+        render.done.set()
+
+    def reuse(self, key: tuple, source: str, output_path: str):
+        """使用相同键已经生成的输出"""
+        linked = link_output(source, output_path)
+        with self._lock:
+            if linked:
+                self.linked += 1
+            else:
+                self.copied += 1
+            self.saved_seconds += self._renders[key].seconds
+        logger.debug(f"[dedup]{output_path} {'linked' if linked else 'copied'} from {source}")
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'duplicates': len(self._content or ()),
+                'linked': self.linked,
+                'copied': self.copied,
+                'saved_seconds': round(self.saved_seconds, 3),
+            }
@@ -0,0 +1,431 @@
+"""
+任务调度
+
+所有批处理任务共享同一个工作线程池, 工作线程按轮转方式从各个任务中领取文件, 多个任务并发时平分处理能力
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Optional
+
+from core.batch import ProgressChannel
+from core.journal import JobJournal, QUEUED, RUNNING, DONE, SKIPPED, FAILED, JOB_RUNNING, JOB_DONE, JOB_CANCELLED
+from core.logger import logger
+from core.memory import MemoryBudget, set_reservation, reset_reservation
+from core.profiling import JobProfiler
+from core.tracing import Tracer, now_us, set_tracer, reset_tracer, span
+from processor.core import ProcessCancelled, check_cancelled, set_cancel_event, reset_cancel_event
+
+
+# 观察者全部断开后, 等待重新连接的时间（秒）
+DISCONNECT_GRACE = 10.0
+
+
+class Job:
+    """批处理任务, 由 JobScheduler 调度执行"""
+
+    def __init__(self, job_id: str, files: list[str], handler: Callable[[str], tuple[bool, bool, Optional[str]]],
+                 journal: JobJournal = None, cancel_on_disconnect: bool = False, trace_path: Path = None,
+                 estimate_memory: Callable[[str], int] = None, stats: Callable[[], dict] = None):
+        """
+        Args:
+            job_id: 任务 id
+            files: 待处理的文件
+            handler: 处理单个文件, 返回 (success, skipped, error_message)
+            journal: 任务日志, 为 None 时不记录
+            cancel_on_disconnect: 所有进度观察者断开且 DISCONNECT_GRACE 秒内没有重新连接时取消任务
+            trace_path: 记录每个文件的处理耗时, 任务结束时以 Chrome trace 格式写入该路径, 为 None 时不记录
+            estimate_memory: 估算处理单个文件的内存峰值（字节）, 供调度器做准入控制
+            stats: 任务的附加统计, 包含在 status 和 complete 事件中
+        """
+        self.id = job_id
+        self.total = len(files)
+        self.handler = handler
+        self.journal = journal
+        self.progress = ProgressChannel()
+        self.state = JOB_RUNNING
+        self.done_event = threading.Event()
+        self.counters = {'processed': 0, 'success': 0, 'failure': 0, 'skipped': 0}
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.trace_path = trace_path
+        self.estimate_memory = estimate_memory
+        self.stats = stats
+        self.tracer = Tracer(f'job {job_id}') if trace_path is not None else None
+        self._submitted_us = now_us()
+        # 按需附加的采样分析器, 见 attach_profiler
+        self.profiler: Optional[JobProfiler] = None
+        self._cancel_event = threading.Event()
+        self._watchers = 0
+        self._pending = deque(files)
+        self._running = 0
+        # 队首文件的内存预估 (路径, 字节), 由工作线程在调度器的锁外计算, 等待准入期间不重复读取文件头
+        self._head_cost: tuple[Optional[str], int] = (None, 0)
+        self._lock = threading.Lock()
+        self.progress.publish('start', {
+            'job_id': self.id,
+            'total': self.total,
+            'message': f'开始处理 {self.total} 个文件...'
+        })
+
+    def status(self) -> dict:
+        with self._lock:
+            status = {
+                'job_id': self.id,
+                'state': self.state,
+                'total': self.total,
+                'queued': len(self._pending),
+                'running': self._running,
+                **self.counters,
+            }
+        if self.stats is not None:
+            status.update(self.stats())
+        return status
+
+    def cancel(self):
+        """取消任务, 丢弃尚未开始的文件, 正在处理的文件在下一个节点开始前停止"""
+        with self._lock:
+            if self.state != JOB_RUNNING:
+                return
+            self.state = JOB_CANCELLED
+            self._pending.clear()
+            self._cancel_event.set()
+            finished = self._running == 0
+        if finished:
+            self._finish()
+
+    def attach(self):
+        """进度观察者连接"""
+        with self._lock:
+            self._watchers += 1
+
+    def detach(self):
+        """进度观察者断开, 没有观察者时开始等待重新连接"""
+        with self._lock:
+            self._watchers -= 1
+            unwatched = self._watchers == 0
+        if unwatched and self.cancel_on_disconnect and not self.done_event.is_set():
+            timer = threading.Timer(DISCONNECT_GRACE, self._cancel_if_unwatched)
+            timer.daemon = True
+            timer.start()
+
+    def _cancel_if_unwatched(self):
+        with self._lock:
+            unwatched = self._watchers == 0
+        if unwatched and not self.done_event.is_set():
+            logger.info(f"任务 {self.id} 的进度连接已断开, 取消任务")
+            self.cancel()
+
+    def attach_profiler(self, profiler: JobProfiler):
+        """对接下来开始处理的文件进行采样分析, 替换之前附加的分析器"""
+        previous, self.profiler = self.profiler, profiler
+        if previous is not None:
+            previous.flush()
+        if self.done_event.is_set():
+            profiler.flush()
+
+    def peek(self) -> Optional[str]:
+        """下一个待处理的文件, 没有时返回 None"""
+        with self._lock:
+            return self._pending[0] if self._pending else None
+
+    def take(self, path: str) -> bool:
+        """领取 peek 返回的文件, 期间任务被取消时返回 False"""
+        with self._lock:
+            if not self._pending or self._pending[0] != path:
+                return False
+            self._running += 1
+            self._pending.popleft()
+            return True
+
+    def memory_cost(self, path: str) -> Optional[int]:
+        """处理 path 的预估内存, 没有 estimate_memory 时为 0, 尚未调用 estimate_head 估算时为 None"""
+        if self.estimate_memory is None:
+            return 0
+        with self._lock:
+            head_path, cost = self._head_cost
+        return cost if head_path == path else None
+
+    def estimate_head(self):
+        """估算队首文件的内存, 需要读取文件头, 不能在调度器的锁内调用"""
+        path = self.peek()
+        if path is None or self.estimate_memory is None or self.memory_cost(path) is not None:
+            return
+        try:
+            cost = self.estimate_memory(path)
+        except Exception as e:
+            logger.warning(f"估算文件内存失败 {path}: {e}")
+            cost = 0
+        with self._lock:
+            self._head_cost = (path, cost)
+
+    def run(self, path: str):
+        """处理领取到的文件, 记录任务日志出错时该文件按失败计入, 任务仍然可以结束"""
+        file_name = os.path.basename(path)
+        try:
+            status, error = self._process(path, file_name)
+        except Exception as e:
+            logger.error(f"任务 {self.id} 处理文件 {path} 时出错: {e}")
+            status, error = 'failure', str(e)
+
+        with self._lock:
+            if status != 'cancelled':
+                self.counters[status] += 1
+                self.counters['processed'] += 1
+            self._running -= 1
+            finished = self._running == 0 and not self._pending
+
+        status_text = {'success': '完成', 'failure': '失败', 'skipped': '跳过', 'cancelled': '已取消'}[status]
+        self._publish('progress', file_name, f'{status_text}: {file_name}', status=status, error=error)
+        if finished:
+            self._finish()
+
+    def _process(self, path: str, file_name: str) -> tuple[str, Optional[str]]:
+        """调用 handler 并记录任务日志, 返回 (状态, 错误信息), 状态为 success、failure、skipped 或 cancelled"""
+        # 领取之后任务被取消
+        if self._cancel_event.is_set():
+            return self._on_cancelled(path)
+        self._publish('progress', file_name, f'正在处理: {file_name}')
+        if self.journal is not None:
+            self.journal.mark(self.id, path, RUNNING)
+
+        token = set_cancel_event(self._cancel_event)
+        trace_token = set_tracer(self.tracer)
+        profiler = self.profiler
+        profiling = profiler is not None and profiler.acquire()
+        try:
+            if self.tracer is not None:
+                self.tracer.complete('queue wait', 'queue', self._submitted_us, now_us() - self._submitted_us,
+                                     {'file': file_name})
+            with span(file_name, 'file', path=path), profiler.profile() if profiling else nullcontext():
+                success, skipped, error = self.handler(path)
+        except ProcessCancelled:
+            return self._on_cancelled(path)
+        except Exception as e:
+            logger.error(f"处理文件失败 {path}: {e}")
+            success, skipped, error = False, False, str(e)
+        finally:
+            reset_tracer(trace_token)
+            reset_cancel_event(token)
+
+        if skipped:
+            status = 'skipped'
+        elif success:
+            status = 'success'
+        else:
+            status = 'failure'
+        if self.journal is not None:
+            self.journal.mark(self.id, path, {'skipped': SKIPPED, 'success': DONE, 'failure': FAILED}[status], error)
+        return status, error
+
+    def _on_cancelled(self, path: str) -> tuple[str, None]:
+        """处理中途被取消的文件恢复为 queued, 之后继续任务时重新处理"""
+        if self.journal is not None:
+            self.journal.mark(self.id, path, QUEUED)
+        return 'cancelled', None
+
+    def _finish(self):
+        with self._lock:
+            if self.done_event.is_set():
+                return
+            if self.state == JOB_RUNNING:
+                self.state = JOB_DONE
+            counters = dict(self.counters)
+        if self.journal is not None:
+            try:
+                self.journal.set_job_state(self.id, self.state)
+            except Exception as e:
+                logger.error(f"记录任务 {self.id} 的状态失败: {e}")
+        if self.profiler is not None:
+            self.profiler.flush()
+        if self.tracer is not None:
+            try:
+                self.tracer.dump(self.trace_path)
+            except OSError as e:
+                logger.error(f"保存任务 {self.id} 的 trace 失败: {e}")
+        message = f'处理完成! 成功: {counters["success"]}, 跳过: {counters["skipped"]}, 失败: {counters["failure"]}'
+        if self.state == JOB_CANCELLED:
+            message = f'已取消! {message[6:]}'
+        self.progress.publish('complete', {
+            'job_id': self.id,
+            'total': self.total,
+            **counters,
+            'percent': 100,
+            'state': self.state,
+            'message': message,
+            **(self.stats() if self.stats is not None else {}),
+        })
+        self.progress.close()
+        self.done_event.set()
+
+    def _publish(self, event: str, file_name: str, message: str, **extra):
+        with self._lock:
+            counters = dict(self.counters)
+        self.progress.publish(event, {
+            'job_id': self.id,
+            'total': self.total,
+            **counters,
+            'current': file_name,
+            'percent': round((counters['processed'] / self.total) * 100) if self.total > 0 else 0,
+            'message': message,
+            **extra,
+        })
+
+
+class _Reservation:
+    """工作线程当前文件占用的内存预算, 可以在处理期间释放和重新占用"""
+
+    # 重新占用预算时检查取消标记的间隔（秒）
+    WAIT_INTERVAL = 0.5
+
+    def __init__(self, budget: MemoryBudget, cost: int, cond: threading.Condition):
+        self.budget = budget
+        self.cost = cost
+        self._cond = cond
+        self._released = False
+
+    def release(self):
+        """释放预算, 已经释放时不做任何事"""
+        with self._cond:
+            if self._released:
+                return
+            self._released = True
+            self.budget.release(self.cost)
+            # 释放的预算可能使等待中的文件可以开始
+            self._cond.notify_all()
+
+    def reacquire(self):
+        """重新占用释放的预算, 预算不足时等待其他文件释放, 期间任务被取消时抛出 ProcessCancelled"""
+        with self._cond:
+            if not self._released:
+                return
+            while not self.budget.try_acquire(self.cost):
+                self._cond.wait(self.WAIT_INTERVAL)
+                check_cancelled()
+            self._released = False
+
+
+class JobScheduler:
+    """共享工作线程池的任务调度器"""
+
+    def __init__(self, max_workers: int = 4, history_size: int = 100, memory_budget: MemoryBudget = None):
+        """
+        Args:
+            max_workers: 全局工作线程数
+            history_size: 保留在内存中的已结束任务数量
+            memory_budget: 内存预算, 预估内存超出剩余预算的文件等待其他文件处理完成后再开始, 为 None 时不限制
+        """
+        self.max_workers = max_workers
+        self.history_size = history_size
+        self.memory_budget = memory_budget
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        # 仍有待处理文件的任务, 按轮转顺序排列
+        self._active: deque[Job] = deque()
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+
+    def submit(self, job: Job, track: bool = True) -> Job:
+        """
+        提交任务
+
+        Args:
+            job: 任务
+            track: 是否记录在任务列表中供 get、cancel 查询, 监听模式的单文件任务不记录
+        """
+        with self._cond:
+            if track:
+                self._jobs[job.id] = job
+                self._trim_history()
+            self._active.append(job)
+            while len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+        if job.total == 0:
+            job._finish()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done_event.is_set()]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def _next_task(self, unestimated: list[Job]) -> Optional[tuple[Job, str, int]]:
+        """
+        按轮转顺序从下一个任务中领取文件, 同时移除已经没有待处理文件的任务
+
+        设置了内存预算时, 队首文件的预估内存超出剩余预算的任务本轮跳过, 文件留在队列中,
+        其他任务中放得下的文件可以先开始; 队首文件尚未估算内存的任务同样跳过并加入 unestimated,
+        由调用方在锁外估算, 锁内只做预算的加减
+
+        Returns:
+            (任务, 文件路径, 占用的内存预算), 没有可以开始的文件时返回 None
+        """
+        for _ in range(len(self._active)):
+            job = self._active.popleft()
+            path = job.peek()
+            if path is None:
+                continue
+            self._active.append(job)
+            cost = 0
+            if self.memory_budget is not None:
+                cost = job.memory_cost(path)
+                if cost is None:
+                    unestimated.append(job)
+                    continue
+                if not self.memory_budget.try_acquire(cost):
+                    continue
+            if job.take(path):
+                return job, path, cost
+            if self.memory_budget is not None:
+                self.memory_budget.release(cost)
+        return None
+
+    def _worker(self):
+        while True:
+            unestimated: list[Job] = []
+            with self._cond:
+                task = self._next_task(unestimated)
+                while task is None and not unestimated:
+                    self._cond.wait()
+                    task = self._next_task(unestimated)
+            if unestimated:
+                for pending in unestimated:
+                    pending.estimate_head()
+                # 估算完成的文件可能可以由其他空闲的工作线程开始
+                with self._cond:
+                    self._cond.notify_all()
+            if task is None:
+                continue
+            job, path, cost = task
+            if self.memory_budget is None:
+                self._run(job, path)
+                continue
+            reservation = _Reservation(self.memory_budget, cost, self._cond)
+            token = set_reservation(reservation)
+            try:
+                self._run(job, path)
+            finally:
+                reset_reservation(token)
+                reservation.release()
+
+    @staticmethod
+    def _run(job: Job, path: str):
+        """Job.run 之外的异常（如发布进度失败）只记录日志, 工作线程继续处理其他文件"""
+        try:
+            job.run(path)
+        except Exception as e:
+            logger.error(f"工作线程处理任务 {job.id} 的文件 {path} 时出错: {e}")
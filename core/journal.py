@@ -0,0 +1,148 @@
+"""
+任务日志
+
+使用 SQLite 记录每个批处理任务及其文件的处理状态, 服务重启或页面关闭后可以从中断处继续
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# 文件状态
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# 任务状态
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_INTERRUPTED = 'interrupted'
+JOB_CANCELLED = 'cancelled'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    template_name TEXT NOT NULL,
+    input_folder TEXT NOT NULL,
+    output_folder TEXT NOT NULL,
+    override_existed INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_files_state ON files (job_id, state);
+CREATE INDEX IF NOT EXISTS idx_files_path ON files (job_id, path);
+"""
+
+
+class JobJournal:
+    """基于 SQLite 的任务日志, 线程安全"""
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+
+    def create_job(self, files: list[str], template_name: str, input_folder: str, output_folder: str,
+                   override_existed: bool) -> str:
+        """创建任务, 所有文件的初始状态为 queued, 返回任务 id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, template_name, input_folder, output_folder, int(override_existed), JOB_RUNNING,
+                 len(files), now, now))
+            self._conn.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, NULL, ?)',
+                ((job_id, seq, path, QUEUED, now) for seq, path in enumerate(files)))
+        return job_id
+
+    def mark(self, job_id: str, path: str, state: str, error: str = None):
+        """更新文件状态"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE files SET state = ?, error = ?, updated_at = ? WHERE job_id = ? AND path = ?',
+                (state, error, time.time(), job_id, path))
+
+    def set_job_state(self, job_id: str, state: str):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?', (state, time.time(), job_id))
+
+    def claim_job(self, job_id: str) -> bool:
+        """任务不在运行时将其置为 running 并返回 True, 已经在运行时返回 False; 比较和更新是原子的"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state != ?',
+                                        (JOB_RUNNING, time.time(), job_id, JOB_RUNNING))
+        return cursor.rowcount > 0
+
+    def interrupt_running_jobs(self):
+        """将上次运行遗留的 running 任务标记为 interrupted, 在服务启动时调用"""
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?',
+                               (JOB_INTERRUPTED, time.time(), JOB_RUNNING))
+
+    def pending_files(self, job_id: str, retry_failed: bool = False) -> list[str]:
+        """
+        获取尚未完成的文件, 按提交顺序排列
+
+        Args:
+            job_id: 任务 id
+            retry_failed: 是否包含处理失败的文件
+        """
+        states = (QUEUED, RUNNING, FAILED) if retry_failed else (QUEUED, RUNNING)
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT path FROM files WHERE job_id = ? AND state IN ({",".join("?" * len(states))}) ORDER BY seq',
+                (job_id, *states)).fetchall()
+        return [row['path'] for row in rows]
+
+    def get_job(self, job_id: str) -> dict | None:
+        """获取任务信息及各状态的文件数量"""
+        with self._lock:
+            job = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = self._conn.execute(
+                'SELECT state, COUNT(*) AS n FROM files WHERE job_id = ? GROUP BY state', (job_id,)).fetchall()
+        result = dict(job)
+        result['override_existed'] = bool(result['override_existed'])
+        result['counts'] = {state: 0 for state in (QUEUED, RUNNING, DONE, SKIPPED, FAILED)}
+        result['counts'].update({row['state']: row['n'] for row in counts})
+        return result
+
+    def get_files(self, job_id: str, state: str = None) -> list[dict]:
+        """获取任务中每个文件的状态"""
+        sql = 'SELECT path, state, error, updated_at FROM files WHERE job_id = ?'
+        params = [job_id]
+        if state:
+            sql += ' AND state = ?'
+            params.append(state)
+        with self._lock:
+            rows = self._conn.execute(sql + ' ORDER BY seq', params).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_jobs(self, limit: int = 50) -> list[dict]:
+        """按创建时间倒序列出任务"""
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [dict(row) for row in rows]
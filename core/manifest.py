@@ -0,0 +1,131 @@
+"""
+输出清单
+
+记录每个输出文件对应的输入指纹、模板和保存参数, 只有它们发生变化时才重新渲染
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    output_path TEXT PRIMARY KEY,
+    input_path TEXT NOT NULL,
+    input_size INTEGER NOT NULL,
+    input_mtime_ns INTEGER NOT NULL,
+    input_digest TEXT NOT NULL,
+    template_digest TEXT,
+    render_digest TEXT NOT NULL,
+    config_digest TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def text_digest(*parts) -> str:
+    """计算若干字符串的摘要"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """计算文件内容的摘要"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+# 抽样数据块的大小和位置（文件开头、中间、结尾）
+SAMPLE_BLOCK = 64 * 1024
+# 清单中抽样摘要的前缀, 没有前缀的是完整摘要
+SAMPLED_PREFIX = 'sampled:'
+
+
+def sampled_digest(path: str, size: int) -> str:
+    """文件开头、中间、结尾各一个数据块的摘要, 小文件读取全部内容"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= 3 * SAMPLE_BLOCK:
+            h.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_BLOCK) // 2, size - SAMPLE_BLOCK):
+                f.seek(offset)
+                h.update(f.read(SAMPLE_BLOCK))
+    return h.hexdigest()
+
+
+class OutputManifest:
+    """基于 SQLite 的输出清单, 线程安全"""
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+
+    def get(self, output_path: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM outputs WHERE output_path = ?',
+                                     (os.path.abspath(output_path),)).fetchone()
+        return dict(row) if row else None
+
+    def input_unchanged(self, entry: dict, input_path: str) -> bool:
+        """
+        判断输入文件是否与清单记录一致
+
+        size 和 mtime 一致时直接认为未变化, 否则再比较内容摘要（例如文件被复制或 touch 过）;
+        记录的是抽样摘要时比较抽样摘要
+        """
+        stat = os.stat(input_path)
+        if entry['input_path'] == os.path.abspath(input_path) and \
+                (stat.st_size, stat.st_mtime_ns) == (entry['input_size'], entry['input_mtime_ns']):
+            return True
+        if stat.st_size != entry['input_size']:
+            return False
+        recorded = entry['input_digest']
+        if recorded.startswith(SAMPLED_PREFIX):
+            unchanged = SAMPLED_PREFIX + sampled_digest(input_path, stat.st_size) == recorded
+        else:
+            unchanged = file_digest(input_path) == recorded
+        if not unchanged:
+            return False
+        # 内容未变化, 更新记录的 mtime, 下次可以直接比较 stat
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE outputs SET input_path = ?, input_mtime_ns = ?, updated_at = ? WHERE output_path = ?',
+                (os.path.abspath(input_path), stat.st_mtime_ns, time.time(), entry['output_path']))
+        return True
+
+    def touch_template(self, output_path: str, template_digest: str):
+        """模板改动没有影响该文件的渲染结果时, 只更新模板摘要"""
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE outputs SET template_digest = ?, updated_at = ? WHERE output_path = ?',
+                               (template_digest, time.time(), os.path.abspath(output_path)))
+
+    def put(self, output_path: str, input_path: str, template_digest: str | None, render_digest: str,
+            config_digest: str, input_digest: str = None):
+        """
+        记录一次成功的渲染
+
+        Args:
+            input_digest: 已经计算好的输入文件完整摘要（如批次内去重时计算的）, 为 None 时只记录抽样摘要,
+                避免每次渲染后再完整读取一遍输入文件
+        """
+        stat = os.stat(input_path)
+        if input_digest is None:
+            input_digest = SAMPLED_PREFIX + sampled_digest(input_path, stat.st_size)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(output_path), os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns,
+                 input_digest, template_digest, render_digest, config_digest, time.time()))
@@ -0,0 +1,264 @@
+"""
+内存预估与准入控制
+
+根据照片头信息中的尺寸（不解码）和模板中的处理器估算单个文件处理时的内存峰值,
+调度器按配置的内存预算决定同时处理哪些文件, 避免多个大尺寸照片同时处理时内存耗尽。
+处理器运行时记录实际的内存峰值, 用于校准各处理器的每像素内存占用
+"""
+import os
+import re
+import threading
+from collections import deque
+from contextvars import ContextVar, Token
+from typing import Any, Iterable, Optional
+
+from PIL import Image
+
+from core.logger import logger
+
+# 解码后的图像每像素占用的字节数, Pillow 中 RGB 图像按 4 字节存储
+DECODE_BYTES_PER_PIXEL = 4
+# 各处理器相对输入像素数的内存峰值（字节/像素）, 包括输出图像和中间结果, 未校准时使用
+DEFAULT_BYTES_PER_PIXEL = {
+    'blur': 8,
+    'resize': 4,
+    'trim': 8,
+    'margin': 4,
+    'margin_with_ratio': 4,
+    'watermark': 8,
+    'watermark_with_timestamp': 4,
+    'rounded_corner': 9,
+    'shadow': 32,
+    'crop': 4,
+    'concat': 8,
+    'alignment': 8,
+    'solid_color': 4,
+    'gradient_color': 8,
+    'image': 4,
+    # 文字生成器的尺寸与输入照片无关
+    'rich_text': 0,
+    'multi_rich_text': 0,
+}
+UNKNOWN_BYTES_PER_PIXEL = 8
+
+# 只对输入不小于该像素数的处理器调用进行校准, 小图的测量误差太大
+CALIBRATION_MIN_PIXELS = 1_000_000
+# 每个处理器保留的校准样本数
+CALIBRATION_WINDOW = 64
+# 至少有这么多样本后才使用校准值
+CALIBRATION_MIN_SAMPLES = 4
+
+_processor_name_pattern = re.compile(r'"processor_name"\s*:\s*"([^"]+)"')
+
+
+def template_processors(template_source: str) -> list[str]:
+    """模板中出现的所有处理器名称, 包括嵌套在 watermark 等处理器参数中的"""
+    return _processor_name_pattern.findall(template_source)
+
+
+def image_pixels(path: str) -> int:
+    """只读取文件头获取像素数, 读取失败时返回 0"""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+        return width * height
+    except Exception as e:
+        logger.warning(f"读取图像尺寸失败 {path}: {e}")
+        return 0
+
+
+def total_memory() -> Optional[int]:
+    """物理内存大小, 无法获取时返回 None"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _read_status_kb(key: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class MemoryModel:
+    """各处理器每像素内存峰值的估计, 随实际测量结果校准"""
+
+    def __init__(self):
+        self._samples: dict[str, deque[float]] = {}
+        self._lock = threading.Lock()
+        # 进程的 RSS 峰值只有一个, 同一时间只进行一次测量
+        self._measure_lock = threading.Lock()
+        self._measurable = _reset_peak_rss() and _read_status_kb('VmHWM') is not None
+
+    def bytes_per_pixel(self, processor_name: str) -> float:
+        default = DEFAULT_BYTES_PER_PIXEL.get(processor_name, UNKNOWN_BYTES_PER_PIXEL)
+        with self._lock:
+            samples = sorted(self._samples.get(processor_name, ()))
+        if len(samples) < CALIBRATION_MIN_SAMPLES:
+            return default
+        # 取较高的分位数, 偏保守
+        return samples[int(len(samples) * .9)]
+
+    def estimate(self, pixels: int, processors: Iterable[str]) -> int:
+        """
+        估算处理一个文件的内存峰值（字节）
+
+        管道会保留每个节点的输出直到处理结束, 因此按所有节点之和估算
+        """
+        return int(pixels * (DECODE_BYTES_PER_PIXEL + sum(self.bytes_per_pixel(name) for name in processors)))
+
+    def observe(self, processor_name: str, bytes_per_pixel: float):
+        with self._lock:
+            samples = self._samples.get(processor_name)
+            if samples is None:
+                samples = self._samples[processor_name] = deque(maxlen=CALIBRATION_WINDOW)
+            samples.append(bytes_per_pixel)
+
+    def begin_measure(self, pixels: int) -> Optional[int]:
+        """
+        开始测量一次处理器调用, 返回测量开始时的 RSS（KB）; 输入太小、正在进行其他测量或平台不支持时返回 None
+
+        测量使用进程的 RSS 峰值, 其他线程同时分配的内存也会计入, 结果偏保守
+        """
+        if not self._measurable or pixels < CALIBRATION_MIN_PIXELS:
+            return None
+        if not self._measure_lock.acquire(blocking=False):
+            return None
+        if not _reset_peak_rss():
+            self._measure_lock.release()
+            return None
+        rss = _read_status_kb('VmRSS')
+        if rss is None:
+            self._measure_lock.release()
+        return rss
+
+    def end_measure(self, processor_name: str, pixels: int, rss_before: int, output_bytes: int = 0):
+        """
+        结束测量并记录样本
+
+        分配器复用已释放的内存时 RSS 峰值不会增长, 测量值可能远小于实际占用,
+        因此样本不低于处理器输出图像本身的大小 output_bytes
+        """
+        try:
+            peak = _read_status_kb('VmHWM')
+        finally:
+            self._measure_lock.release()
+        if peak is not None:
+            self.observe(processor_name, max((peak - rss_before) * 1024, output_bytes, 0) / pixels)
+
+    def status(self) -> dict:
+        with self._lock:
+            names = set(DEFAULT_BYTES_PER_PIXEL) | set(self._samples)
+            counts = {name: len(samples) for name, samples in self._samples.items()}
+        return {name: {'bytes_per_pixel': round(self.bytes_per_pixel(name), 2), 'samples': counts.get(name, 0)}
+                for name in sorted(names)}
+
+
+class MemoryBudget:
+    """
+    内存预算
+
+    估算值不超过剩余预算的文件才能开始处理; 当前没有文件在处理时总是放行, 避免超过预算的单个文件永远等待
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, nbytes: int) -> bool:
+        """预算足够时占用 nbytes 并返回 True, 否则不占用并返回 False"""
+        with self._lock:
+            if self.running > 0 and self.used + nbytes > self.limit:
+                return False
+            self.used += nbytes
+            self.running += 1
+            return True
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.used -= nbytes
+            self.running -= 1
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'limit': self.limit, 'used': self.used, 'running': self.running}
+
+
+memory_model = MemoryModel()
+
+# 当前线程所处理文件占用的内存预算, 由任务调度器设置, 提供 release() 和 reacquire() 两个方法
+_reservation: ContextVar[Optional[Any]] = ContextVar('memory_reservation', default=None)
+
+
+def set_reservation(reservation) -> Token:
+    """
+    设置当前上下文的内存预算, 返回用于恢复的 Token
+
+    reservation.release() 释放预算, 需要可以重复调用; reservation.reacquire() 在释放之后重新占用, 预算不足时等待
+    """
+    return _reservation.set(reservation)
+
+
+def reset_reservation(token: Token):
+    _reservation.reset(token)
+
+
+def release_reservation():
+    """提前释放当前文件占用的内存预算, 用于不再需要解码、处理图像的情况（如等待批次内重复文件的输出）"""
+    reservation = _reservation.get()
+    if reservation is not None:
+        reservation.release()
+
+
+def reacquire_reservation():
+    """重新占用 release_reservation 释放的内存预算, 用于释放之后又需要处理图像的情况; 没有释放过时不做任何事"""
+    reservation = _reservation.get()
+    if reservation is not None:
+        reservation.reacquire()
+
+
+def buffer_pixels(buffer) -> int:
+    """buffer 中所有图像的像素数之和"""
+    return sum(img.width * img.height for img in buffer or ())
+
+
+# Pillow 中各模式每像素实际占用的字节数, 未列出的模式（RGB、RGBA、I、F 等）为 4 字节
+_STORED_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2}
+
+
+def buffer_bytes(buffer) -> int:
+    """buffer 中所有图像占用的内存（字节）"""
+    return sum(img.width * img.height * _STORED_BYTES_PER_PIXEL.get(img.mode, 4) for img in buffer or ())
+
+
+def parse_memory_budget(value: str) -> Optional[int]:
+    """
+    解析配置中的内存预算
+
+    auto: 物理内存的 75%; off 或 0: 不限制; 其他: 以 MB 为单位的数值
+    """
+    value = (value or 'auto').strip().lower()
+    if value == 'auto':
+        total = total_memory()
+        return int(total * .75) if total else None
+    if value in ('off', 'none', ''):
+        return None
+    megabytes = float(value)
+    return int(megabytes * 1024 * 1024) if megabytes > 0 else None
@@ -0,0 +1,113 @@
+"""
+进程内性能指标
+
+按处理器、处理阶段（exif、模板渲染、解码、编码）收集耗时, 以 Prometheus 文本格式输出
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 每个序列保留的最近样本数, 用于计算分位数
+SAMPLE_WINDOW = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    单个序列的耗时统计
+
+    count、sum 为进程启动以来的累计值; 分位数基于最近 SAMPLE_WINDOW 个样本
+    """
+
+    def __init__(self, window: int = SAMPLE_WINDOW):
+        self.count = 0
+        self.sum = 0.
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self._samples.append(value)
+
+    def quantiles(self, qs=QUANTILES) -> dict[float, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {q: math.nan for q in qs}
+        return {q: samples[min(int(q * len(samples)), len(samples) - 1)] for q in qs}
+
+
+class MetricsRegistry:
+    """指标名 -> 标签 -> Histogram"""
+
+    def __init__(self):
+        self._metrics: dict[str, dict[tuple, Histogram]] = {}
+        self._help: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metrics.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """统计代码块的耗时（秒）, 出现异常时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict[str, dict[tuple, dict]]:
+        with self._lock:
+            return {
+                name: {key: {'count': h.count, 'sum': h.sum, 'quantiles': h.quantiles()} for key, h in series.items()}
+                for name, series in self._metrics.items()
+            }
+
+    def render_prometheus(self) -> str:
+        """Prometheus 文本格式 (summary 类型)"""
+        lines = []
+        for name, series in sorted(self.snapshot().items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for key, stats in sorted(series.items()):
+                labels = [f'{k}="{_escape(v)}"' for k, v in key]
+                for q, value in stats['quantiles'].items():
+                    quantile_labels = _format_labels(labels + ['quantile="%s"' % q])
+                    lines.append(f"{name}{quantile_labels} {_format_value(value)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(stats['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {stats['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: list[str]) -> str:
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    return 'NaN' if math.isnan(value) else repr(float(value))
+
+
+metrics = MetricsRegistry()
+
+PROCESSOR_SECONDS = 'semi_utils_processor_seconds'
+STAGE_SECONDS = 'semi_utils_stage_seconds'
+PREVIEW_SECONDS = 'semi_utils_preview_seconds'
+metrics.describe(PROCESSOR_SECONDS, 'Time spent in ImageProcessor.process, by processor.')
+metrics.describe(STAGE_SECONDS, 'Time spent in pipeline stages (exif, render, decode, encode).')
+metrics.describe(PREVIEW_SECONDS, 'Latency of template previews, by stage (decode, render, pipeline, encode, total).')
@@ -0,0 +1,129 @@
+"""
+模板编辑时的低分辨率预览
+
+编辑模板时按完整尺寸渲染一张 4500 万像素的照片需要数秒。预览按缩小后的图像执行同一个管道:
+解码时通过内嵌预览图或 JPEG 的 DCT 缩放直接得到小图, 渲染模板时 vw、vh 按缩小后的尺寸计算,
+模板中写定的像素参数（边距、圆角、字号等）按同一比例缩放, 使预览的版式与最终输出一致
+"""
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+from jinja2 import Template
+
+from core.batch import render_context
+from core.metrics import metrics, PREVIEW_SECONDS
+from core.tracing import span
+from core.util import get_exif, get_preview
+from processor.core import start_process, scale_pixel_params
+
+# 预览图长边的默认像素数
+PREVIEW_LONG_EDGE = 1200
+
+# exif 缓存: 文件路径 -> (文件大小, st_mtime_ns, exif), 编辑模板时同一张照片会反复预览, 按 LRU 淘汰
+_EXIF_CACHE_SIZE = 64
+_exif_cache: OrderedDict[str, tuple[int, int, dict]] = OrderedDict()
+_exif_cache_lock = threading.Lock()
+
+
+def _cached_exif(path: str) -> dict:
+    stat = os.stat(path)
+    with _exif_cache_lock:
+        entry = _exif_cache.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            _exif_cache.move_to_end(path)
+            return entry[2]
+    exif = get_exif(path)
+    # 读取失败时返回空字典, 不缓存
+    if not exif:
+        return exif
+    with _exif_cache_lock:
+        _exif_cache[path] = (stat.st_size, stat.st_mtime_ns, exif)
+        _exif_cache.move_to_end(path)
+        while len(_exif_cache) > _EXIF_CACHE_SIZE:
+            _exif_cache.popitem(last=False)
+    return exif
+
+
+def _scaled_exif(exif: dict, factor: float) -> dict:
+    """ImageWidth、ImageHeight 按 factor 缩放后的 exif, 使 vw、vh 和按宽高比计算的处理器使用预览尺寸"""
+    scaled = dict(exif)
+    for key in ('ImageWidth', 'ImageHeight'):
+        try:
+            scaled[key] = str(max(int(round(int(exif[key]) * factor)), 1))
+        except (KeyError, ValueError):
+            pass
+    return scaled
+
+
+def _same_file(path: str, input_path: str) -> bool:
+    try:
+        return os.path.samefile(path, input_path)
+    except OSError:
+        return False
+
+
+def _load(path: str, factor: float) -> Image.Image:
+    """其他图像文件按同一比例缩小后使用, 与原图在管道中的相对尺寸保持不变"""
+    img = ImageOps.exif_transpose(Image.open(path))
+    if factor < 1:
+        img = img.resize((max(round(img.width * factor), 1), max(round(img.height * factor), 1)), Image.LANCZOS)
+    return img
+
+
+def render_preview(template: Template, input_path: str, size: int = PREVIEW_LONG_EDGE) -> Image.Image:
+    """
+    按长边不超过 size 的尺寸渲染模板
+
+    Args:
+        template: 模板
+        input_path: 照片路径
+        size: 预览图长边像素数
+
+    Returns:
+        管道的输出图像
+    """
+    with span('preview', 'pipeline', size=size):
+        with metrics.timer(PREVIEW_SECONDS, stage='decode'):
+            exif = _cached_exif(input_path)
+            with Image.open(input_path) as img:
+                # 旋转不改变长边
+                full_edge = max(img.size)
+            preview = get_preview(input_path, size)
+        factor = max(preview.size) / full_edge if full_edge else 1.
+
+        with metrics.timer(PREVIEW_SECONDS, stage='render'):
+            # 按原图尺寸渲染一次作为参照, 与按预览尺寸渲染的结果比较, 区分写定的像素值和由 vw、vh 计算的值
+            reference = json.loads(template.render(render_context(input_path, exif)))
+            scaled_exif = _scaled_exif(exif, factor)
+            data = json.loads(template.render(render_context(input_path, scaled_exif)))
+            if factor < 1:
+                scale_pixel_params(data, reference, factor)
+            for node in data:
+                node.setdefault('exif', scaled_exif)
+                # 读取输入文件的节点（如背景模糊）同样使用预览图, 不解码原图
+                if node.get('buffer_path') and not node.get('buffer_loaded'):
+                    node['buffer'] = [preview.copy() if _same_file(path, input_path) else _load(path, factor)
+                                      for path in node['buffer_path']]
+                    node['buffer_loaded'] = True
+
+        with metrics.timer(PREVIEW_SECONDS, stage='pipeline'):
+            result = start_process(data, initial_buffer=[preview])
+    return result
+
+
+def render_preview_jpeg(template: Template, input_path: str, size: int = PREVIEW_LONG_EDGE,
+                        quality: int = 85) -> io.BytesIO:
+    """渲染预览并编码为 JPEG 字节流"""
+    started = time.perf_counter()
+    result = render_preview(template, input_path, size)
+    with metrics.timer(PREVIEW_SECONDS, stage='encode'):
+        buffer = io.BytesIO()
+        (result if result.mode == 'RGB' else result.convert('RGB')).save(buffer, format='JPEG', quality=quality)
+        buffer.seek(0)
+    metrics.observe(PREVIEW_SECONDS, time.perf_counter() - started, stage='total')
+    return buffer
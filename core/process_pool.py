@@ -0,0 +1,88 @@
+"""
+多进程执行处理管道
+
+处理管道大部分时间在 Pillow 和 NumPy 中, 但文字排版、调度等 Python 代码仍受 GIL 限制, 多进程可以进一步利用多核。
+父进程只向工作进程传递渲染后的模板和文件路径, 工作进程自行解码输入文件并直接写入输出文件, 进程之间不传递图像。
+
+限制:
+    - 工作进程中记录的指标和 trace 不汇总到父进程
+    - 批次内不变的节点（见 core.batch.BatchHoisting）不在进程之间共享, 使用进程池时不预先计算
+
+每个文件附带一个由 multiprocessing.Manager 管理的取消事件, 任务取消时父进程设置该事件,
+工作进程中的管道在节点之间检查（与线程中执行时相同）
+"""
+import os
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing import get_context
+from typing import List
+
+from core.configs import ConfigSnapshot, config_snapshot, set_config_snapshot
+from core.logger import init_from_config
+from processor.core import ProcessCancelled, check_cancelled, set_cancel_event, reset_cancel_event
+
+# 等待工作进程期间检查取消标记的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.2
+
+
+def _init_worker(band_threads: int, config: ConfigSnapshot):
+    # 启动时使用主进程的配置快照, 之后配置文件有修改时按 mtime 重新读取
+    set_config_snapshot(config)
+    # 工作进程不导入 app, 在这里初始化日志系统
+    init_from_config(config)
+    import processor  # noqa: F401 注册处理器和 HEIC 支持
+    from processor.tiling import set_band_threads
+    set_band_threads(band_threads)
+
+
+def _run_pipeline(data: List[dict], input_path: str, output_path: str, cancel_event):
+    """在工作进程中执行管道并保存输出, cancel_event 被设置后在下一个节点开始前抛出 ProcessCancelled"""
+    from processor.core import start_process
+    token = set_cancel_event(cancel_event)
+    try:
+        start_process(data, input_path, output_path)
+    finally:
+        reset_cancel_event(token)
+
+
+class ProcessPipelinePool:
+    """按文件路径执行处理管道的多进程执行器"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        # spawn 避免在多线程的 Web 服务进程中 fork
+        context = get_context('spawn')
+        # 管理跨进程的取消事件
+        self._manager = context.Manager()
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // max_workers), config_snapshot()),
+        )
+
+    def run(self, data: List[dict], input_path: str, output_path: str):
+        """
+        在工作进程中处理 input_path 并将结果写入 output_path
+
+        等待期间任务被取消时通知工作进程, 工作进程中的管道在下一个节点开始前停止并抛出 ProcessCancelled
+        """
+        check_cancelled()
+        cancel_event = self._manager.Event()
+        future = self._executor.submit(_run_pipeline, data, input_path, output_path, cancel_event)
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_INTERVAL)
+            except FutureTimeoutError:
+                pass
+            except CancelledError:
+                raise ProcessCancelled()
+            try:
+                check_cancelled()
+            except ProcessCancelled:
+                cancel_event.set()
+                # 尚未交给工作进程的文件直接移除
+                future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
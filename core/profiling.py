@@ -0,0 +1,171 @@
+"""
+按需采样分析
+
+对运行中任务的若干个文件进行采样分析: 后台线程定时采集正在处理这些文件的线程的调用栈,
+结束后输出 .pstats 文件和 collapsed-stack 火焰图文件。
+
+Python 3.12 起 cProfile 基于 sys.monitoring, 对整个进程生效且同一时间只能启用一个,
+多个工作线程并发处理时无法只分析某个文件, 因此这里使用调用栈采样
+"""
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from core.configs import logs_dir
+from core.logger import logger
+
+profiles_dir = logs_dir / 'profiles'
+
+# 默认采样间隔（秒）
+SAMPLE_INTERVAL = 0.005
+
+# 调用栈中的一帧: (文件名, 行号, 函数名), 与 pstats 的函数标识一致
+FrameKey = tuple[str, int, str]
+
+
+class JobProfiler:
+    """对任务中接下来开始处理的 files 个文件进行采样分析"""
+
+    def __init__(self, name: str, files: int = 1, interval: float = SAMPLE_INTERVAL, output_dir: Path = profiles_dir):
+        """
+        Args:
+            name: 输出文件名（不含扩展名）
+            files: 分析的文件数量
+            interval: 采样间隔（秒）
+            output_dir: 输出目录
+        """
+        self.files = files
+        self.interval = interval
+        self.pstats_path = output_dir / f'{name}.pstats'
+        self.collapsed_path = output_dir / f'{name}.collapsed'
+        self.profiled = 0
+        self.samples = 0
+        self.done = False
+        self._remaining = files
+        self._stacks: Counter[tuple[FrameKey, ...]] = Counter()
+        # 正在分析的线程 ident
+        self._targets: set[int] = set()
+        self._lock = threading.Lock()
+        self._sampler: threading.Thread = None
+
+    def acquire(self) -> bool:
+        """领取一个分析名额, 名额用完后返回 False"""
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    @contextmanager
+    def profile(self):
+        """在当前线程中分析代码块, 需要先通过 acquire 领取名额"""
+        ident = threading.get_ident()
+        with self._lock:
+            self._targets.add(ident)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='job-profiler', daemon=True)
+                self._sampler.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._targets.discard(ident)
+                self.profiled += 1
+                finished = self.profiled >= self.files
+            if finished:
+                self.flush()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'files': self.files,
+                'profiled': self.profiled,
+                'samples': self.samples,
+                'done': self.done,
+                'pstats': str(self.pstats_path),
+                'collapsed': str(self.collapsed_path),
+            }
+
+    def flush(self):
+        """停止采样并写入结果, 任务提前结束时也会调用"""
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            self._remaining = 0
+            stacks = Counter(self._stacks)
+        try:
+            self.pstats_path.parent.mkdir(parents=True, exist_ok=True)
+            self._write_pstats(stacks)
+            self._write_collapsed(stacks)
+            logger.info(f"采样分析完成: {self.pstats_path}, {self.collapsed_path}")
+        except OSError as e:
+            logger.error(f"保存采样分析结果失败: {e}")
+
+    def _sample(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if self.done or not self._targets:
+                    self._sampler = None
+                    return
+                targets = set(self._targets)
+            frames = sys._current_frames()
+            sampled = []
+            for ident in targets:
+                frame = frames.get(ident)
+                if frame is None or ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                sampled.append(tuple(reversed(stack)))
+            del frames
+            with self._lock:
+                self._stacks.update(sampled)
+                self.samples += len(sampled)
+            time.sleep(self.interval)
+
+    def _write_collapsed(self, stacks: Counter):
+        """Brendan Gregg 的 collapsed-stack 格式, 可以用 flamegraph.pl、speedscope 等工具打开"""
+        with open(self.collapsed_path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                names = ';'.join(f"{name} ({os.path.basename(filename)}:{line})".replace(';', ':')
+                                 for filename, line, name in stack)
+                f.write(f"{names} {count}\n")
+
+    def _write_pstats(self, stacks: Counter):
+        """
+        由采样结果生成 pstats 可以读取的统计数据
+
+        调用次数为采样次数, 时间为采样次数乘以采样间隔, 只能作为相对值参考
+        """
+        # 函数 -> [cc, nc, tt, ct, callers]
+        stats: dict[FrameKey, list] = {}
+        for stack, count in stacks.items():
+            elapsed = count * self.interval
+            seen = set()
+            for i, key in enumerate(stack):
+                entry = stats.setdefault(key, [0, 0, 0., 0., {}])
+                is_leaf = i == len(stack) - 1
+                if is_leaf:
+                    entry[2] += elapsed
+                # 递归调用只计算一次累计时间
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += elapsed
+                if i > 0:
+                    caller = stack[i - 1]
+                    nc, cc, tt, ct = entry[4].get(caller, (0, 0, 0., 0.))
+                    entry[4][caller] = (nc + count, cc + count, tt + (elapsed if is_leaf else 0.), ct + elapsed)
+        with open(self.pstats_path, 'wb') as f:
+            marshal.dump({key: tuple(value) for key, value in stats.items()}, f)
@@ -0,0 +1,136 @@
+"""
+调试快照的异步写入
+
+调试模板时 save_buffer 会保存每个节点的中间结果, 在处理线程中同步编码写入会使批处理慢数倍。
+开启 debug_capture 后快照放入有界队列, 由后台线程写入; 可以先缩小再保存, 使用压缩快的格式,
+每个目录只保留最近的若干个快照
+"""
+import atexit
+import math
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+
+from PIL import Image
+
+from core.logger import logger
+
+# 快照格式 -> (扩展名, 保存参数), png 使用最低压缩级别, qoi 和 tiff 基本不压缩
+SNAPSHOT_FORMATS = {
+    'png': ('png', {'compress_level': 1}),
+    'qoi': ('qoi', {}),
+    'tiff': ('tiff', {}),
+}
+# 快照文件名: {处理器名}_{时间戳}_{uuid}.{扩展名}, 只有符合该格式的文件参与轮转删除
+_snapshot_name_pattern = re.compile(r'^\w+_\d+_[0-9a-f]{32}\.(png|qoi|tiff|jpg)$')
+
+
+@dataclass(frozen=True)
+class CaptureOptions:
+    """调试快照的保存方式"""
+    # 长边超过该值时先缩小, 0 表示不缩小
+    max_edge: int = 1024
+    format: str = 'png'
+    # 每个目录保留的快照数量, 0 表示不限制
+    keep: int = 500
+
+    @staticmethod
+    def from_config(config) -> 'CaptureOptions':
+        fmt = config.get('DEFAULT', 'debug_capture_format', fallback='png').strip().lower()
+        return CaptureOptions(
+            max_edge=config.getint('DEFAULT', 'debug_capture_max_edge', fallback=1024),
+            format=fmt if fmt in SNAPSHOT_FORMATS else 'png',
+            keep=config.getint('DEFAULT', 'debug_capture_keep', fallback=500),
+        )
+
+
+def _downscale(img: Image.Image, max_edge: int) -> Image.Image:
+    """按整数倍缩小到长边不超过 max_edge, 返回新的图像"""
+    factor = math.ceil(max(img.size) / max_edge) if max_edge > 0 else 1
+    return img.reduce(factor) if factor > 1 else img.copy()
+
+
+class SnapshotWriter:
+    """后台写入快照的线程, 队列满时提交方等待"""
+
+    def __init__(self, max_queue: int = 32):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        # 目录 -> 已写入的快照路径, 按写入顺序
+        self._written: dict[str, deque[str]] = {}
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, directory: str, processor_name: str, img: Image.Image, options: CaptureOptions) -> str:
+        """
+        提交一个快照, 返回将要写入的路径
+
+        图像在提交时缩小或复制, 之后处理器修改原图不会影响快照
+        """
+        ext, _ = SNAPSHOT_FORMATS[options.format]
+        path = os.path.join(directory, f"{processor_name}_{int(time.time())}_{uuid.uuid4().hex}.{ext}")
+        self._ensure_started()
+        self._queue.put((path, _downscale(img, options.max_edge), options))
+        return path
+
+    def flush(self):
+        """等待队列中的快照全部写入"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            path, img, options = self._queue.get()
+            try:
+                self._write(path, img, options)
+            except Exception as e:
+                logger.error(f"保存调试快照失败 {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path: str, img: Image.Image, options: CaptureOptions):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        written = self._written.get(directory)
+        if written is None:
+            written = self._written[directory] = deque(self._existing(directory))
+
+        _, params = SNAPSHOT_FORMATS[options.format]
+        if options.format == 'qoi' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        img.save(path, **params)
+        logger.debug(f"Saved snapshot: {path}")
+        written.append(path)
+        while options.keep > 0 and len(written) > options.keep:
+            try:
+                os.remove(written.popleft())
+            except OSError:
+                pass
+
+    @staticmethod
+    def _existing(directory: str) -> list[str]:
+        """目录中已有的快照, 按修改时间排序, 使保留数量在重启后仍然生效"""
+        try:
+            with os.scandir(directory) as it:
+                entries = [(entry.stat().st_mtime, entry.path) for entry in it
+                           if entry.is_file() and _snapshot_name_pattern.match(entry.name)]
+        except OSError:
+            return []
+        return [path for _, path in sorted(entries)]
+
+
+snapshot_writer = SnapshotWriter()
+atexit.register(snapshot_writer.flush)
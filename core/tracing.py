@@ -0,0 +1,83 @@
+"""
+处理耗时追踪
+
+记录每个文件的排队、exif、模板渲染、各处理器节点、解码、编码耗时, 导出为 Chrome trace / Perfetto 可以打开的 JSON。
+只有通过 set_tracer 设置了 Tracer 的上下文才会记录, 否则 span 不做任何事
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from pathlib import Path
+from typing import Optional
+
+
+def now_us() -> int:
+    """单调时钟, 微秒; 同一台机器上的不同进程之间可以比较"""
+    return time.perf_counter_ns() // 1000
+
+
+class Tracer:
+    """收集一个任务的 trace 事件"""
+
+    def __init__(self, name: str = None):
+        self.name = name
+        self._events: list[dict] = []
+        self._threads: dict[tuple[int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def complete(self, name: str, cat: str, start_us: int, dur_us: int, args: dict = None):
+        """记录一个已结束的 span (Chrome trace 的 X 事件)"""
+        pid, tid = os.getpid(), threading.get_native_id()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start_us, 'dur': dur_us, 'pid': pid, 'tid': tid}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            if (pid, tid) not in self._threads:
+                self._threads[(pid, tid)] = threading.current_thread().name
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                    for (pid, tid), name in threads.items()]
+        metadata += [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': self.name or 'semi-utils'}}
+                     for pid in {pid for pid, _ in threads}]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+_current_tracer: ContextVar[Optional[Tracer]] = ContextVar('tracer', default=None)
+
+
+def set_tracer(tracer: Optional[Tracer]) -> Token:
+    """为当前上下文设置 Tracer, 返回的 token 用于 reset_tracer"""
+    return _current_tracer.set(tracer)
+
+
+def reset_tracer(token: Token):
+    _current_tracer.reset(token)
+
+
+@contextmanager
+def span(name: str, cat: str = 'stage', **args):
+    """记录代码块的耗时, 当前上下文没有 Tracer 时不做任何事"""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield
+        return
+    start = now_us()
+    try:
+        yield
+    finally:
+        tracer.complete(name, cat, start, now_us() - start, args)
@@ -1,3 +1,4 @@
+import hashlib
 import io
 import json
 import os
@@ -5,16 +6,21 @@ import platform
 import re
 import shutil
 import subprocess
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from pathlib import Path
 
-from PIL import Image
+from PIL import Image, ImageOps, ExifTags
 from jinja2 import Template
 
 from core.configs import templates_dir
 from core.jinja2renders import vh, vw, auto_logo
 from core.logger import logger
+from core.metrics import metrics, STAGE_SECONDS
+from core.tracing import span
 
 if platform.system() == 'Windows':
     EXIFTOOL_PATH = Path('./exiftool/exiftool.exe')
@@ -35,7 +41,8 @@ def get_exif(path) -> dict:
     """
     exif_dict = {}
     try:
-        output_bytes = subprocess.check_output([EXIFTOOL_PATH, '-d', '%Y-%m-%d %H:%M:%S%3f%z', path])
+        with metrics.timer(STAGE_SECONDS, stage='exif'), span('exiftool'):
+            output_bytes = subprocess.check_output([EXIFTOOL_PATH, '-d', '%Y-%m-%d %H:%M:%S%3f%z', path])
         output = output_bytes.decode('utf-8', errors='ignore')
 
         lines = output.splitlines()
@@ -64,65 +71,190 @@ def get_exif(path) -> dict:
     return exif_dict
 
 
-def list_files(path: str, suffixes: set[str], depth: int = 0, max_depth: int = 20):
+# 单层目录扫描缓存: 目录路径 -> (目录 st_mtime_ns, 文件夹列表, 文件名列表), 按 LRU 淘汰
+# 只缓存名称: 原地改写文件不会改变目录的 mtime, 文件的 mtime 每次重新读取
+_DIR_CACHE_SIZE = 4096
+_dir_cache: OrderedDict[str, tuple[int, list[str], list[str]]] = OrderedDict()
+_dir_cache_lock = threading.Lock()
+
+# list_files 并发扫描子目录的线程数
+SCAN_WORKERS = 8
+
+
+def _scan_names(path: str) -> tuple[list[str], list[str]]:
+    """
+    用一次 os.scandir 扫描单层目录, 忽略隐藏项和指向文件夹的符号链接
+
+    Returns:
+        (文件夹名列表, 文件名列表), 文件夹按名称倒序
+    """
+    dirs, files = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                # 跳过符号链接，避免无限递归
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    dirs.sort(key=lambda x: x.lower(), reverse=True)
+    return dirs, files
+
+
+def _stat_files(path: str, names: list[str]) -> list[tuple[str, float]]:
+    """
+    读取文件的 mtime, 已经不存在的文件忽略
+
+    Returns:
+        [(文件名, mtime)] 列表, 按 (mtime, 名称) 倒序
+    """
+    files = []
+    for name in names:
+        try:
+            files.append((name, os.stat(os.path.join(path, name)).st_mtime))
+        except FileNotFoundError:
+            continue
+    files.sort(key=lambda x: (x[1], x[0].lower()), reverse=True)
+    return files
+
+
+def _scan_dir(path: str) -> tuple[list[str], list[tuple[str, float]]]:
+    """
+    扫描单层目录
+
+    Returns:
+        (文件夹名列表, [(文件名, mtime)] 列表), 文件夹按名称倒序, 文件按 (mtime, 名称) 倒序
+    """
+    dirs, names = _scan_names(path)
+    return dirs, _stat_files(path, names)
+
+
+def _cached_scan_dir(path: str) -> tuple[list[str], list[tuple[str, float]]]:
+    """
+    带缓存的 _scan_dir: 目录的 mtime 变化（增删、重命名子项）时才重新列出名称, 文件的 mtime 每次读取
+
+    Args:
+        path: 已 resolve 的目录路径
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _dir_cache_lock:
+        cached = _dir_cache.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            _dir_cache.move_to_end(path)
+            return cached[1], _stat_files(path, cached[2])
+
+    dirs, names = _scan_names(path)
+    with _dir_cache_lock:
+        _dir_cache[path] = (mtime_ns, dirs, names)
+        _dir_cache.move_to_end(path)
+        while len(_dir_cache) > _DIR_CACHE_SIZE:
+            _dir_cache.popitem(last=False)
+    return dirs, _stat_files(path, names)
+
+
+def _safe_scan_dir(path: str) -> tuple[list[str], list[tuple[str, float]]]:
+    """扫描失败时记录日志并返回空结果"""
+    try:
+        return _cached_scan_dir(path)
+    except PermissionError:
+        logger.debug(f"list_files: 权限不足，跳过 {path}")
+    except Exception as e:
+        logger.error(f"list_files: 扫描失败 {path}: {e}")
+    return [], []
+
+
+def _build_tree(path: str, scanned: dict, suffixes: set[str]) -> list[dict]:
+    """根据扫描结果组装文件树, 先文件夹后文件, 省略不含目标文件的文件夹"""
+    result = []
+    dirs, files = scanned.get(path, ([], []))
+
+    # 先处理文件夹
+    for name in dirs:
+        child_path = os.path.join(path, name)
+        children = _build_tree(child_path, scanned, suffixes)
+        if children:
+            result.append({
+                'label': name,
+                'value': child_path,
+                'children': children,
+            })
+
+    # 再处理文件
+    for name, _ in files:
+        if os.path.splitext(name)[1].lower() in suffixes:
+            result.append({
+                'label': name,
+                'value': os.path.join(path, name),
+                'is_file': True
+            })
+
+    return result
+
+
+def list_files(path: str, suffixes: set[str], depth: int = 0, max_depth: int = 20,
+               max_workers: int = SCAN_WORKERS):
     """
-    使用 pathlib 实现的版本
+    基于 os.scandir 的版本, 按层使用线程池并发扫描子目录
 
     Args:
         path: 要扫描的路径
         suffixes: 支持的文件后缀
-        depth: 当前递归深度（内部使用）
+        depth: 起始深度
         max_depth: 最大递归深度，防止无限递归
+        max_workers: 并发扫描的线程数
     """
-    result = []
     root = Path(path).resolve()
 
     if not root.exists():
-        return result
+        return []
 
     # 防止递归过深
     if depth > max_depth:
         logger.warning(f"list_files: 达到最大递归深度 {max_depth}，跳过 {path}")
-        return result
+        return []
 
-    try:
-        # 分离文件夹和文件，分别排序
-        items = list(root.iterdir())
-        dirs = sorted([i for i in items if i.is_dir()], key=lambda x: x.name.lower(), reverse=True)
-        files = sorted([i for i in items if i.is_file()], key=lambda x: (x.stat().st_mtime, x.name.lower()),
-                       reverse=True)
-
-        # 先处理文件夹
-        for item in dirs:
-            if item.name.startswith('.'):
-                continue
-            # 跳过符号链接，避免无限递归
-            if item.is_symlink():
-                continue
-            children = list_files(str(item), suffixes, depth + 1, max_depth)
-            if children:
-                result.append({
-                    'label': item.name,
-                    'value': str(item),
-                    'children': children,
-                })
-
-        # 再处理文件
-        for item in files:
-            if item.name.startswith('.'):
-                continue
-            if item.suffix.lower() in suffixes:
-                result.append({
-                    'label': item.name,
-                    'value': str(item),
-                    'is_file': True
-                })
+    scanned = {}
+    level = [str(root)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            next_level = []
+            for dir_path, (dirs, files) in zip(level, executor.map(_safe_scan_dir, level)):
+                scanned[dir_path] = (dirs, files)
+                if depth < max_depth:
+                    next_level.extend(os.path.join(dir_path, name) for name in dirs)
+                elif dirs:
+                    logger.warning(f"list_files: 达到最大递归深度 {max_depth}，跳过 {dir_path} 的子文件夹")
+            level = next_level
+            depth += 1
+
+    return _build_tree(str(root), scanned, suffixes)
 
+
+def list_dir(path: str, suffixes: set[str]) -> list[dict]:
+    """
+    列出单层目录, 供文件树按需展开
+
+    Args:
+        path: 要扫描的目录
+        suffixes: 支持的文件后缀
+
+    Returns:
+        子节点列表, 文件夹在前（带 is_dir 标记, 不含 children）, 文件在后
+    """
+    root = str(Path(path).resolve())
+    try:
+        dirs, files = _cached_scan_dir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
     except PermissionError:
-        logger.debug(f"list_files: 权限不足，跳过 {path}")
-    except Exception as e:
-        logger.error(f"list_files: 扫描失败 {path}: {e}")
+        logger.debug(f"list_dir: 权限不足，跳过 {path}")
+        return []
 
+    result = [{'label': name, 'value': os.path.join(root, name), 'is_dir': True} for name in dirs]
+    result.extend({'label': name, 'value': os.path.join(root, name), 'is_file': True}
+                  for name, _ in files if os.path.splitext(name)[1].lower() in suffixes)
     return result
 
 
@@ -152,6 +284,114 @@ def convert_heic_to_jpeg(path: str, quality: int = 90) -> io.BytesIO:
         return buffer
 
 
+# ==================== 预览图相关方法 ====================
+
+PREVIEW_SIZE = 1280
+
+# EXIF Orientation -> 对应的翻转/旋转方式, 与 ImageOps.exif_transpose 保持一致
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _embedded_preview(img: Image.Image, size: int) -> Image.Image | None:
+    """
+    从已打开的图片中取出长边不小于 size 的内嵌预览图
+
+    依次尝试 MPF 中的大尺寸预览图（相机 JPEG 常见的 VGA / Full HD 预览）和 EXIF IFD1 中的 ThumbnailImage,
+    均不满足时返回 None
+
+    Args:
+        img: 已打开但未解码的图片
+        size: 预览图长边的最小像素数
+
+    Returns:
+        内嵌预览图（未应用 Orientation），不存在时返回 None
+    """
+    # MPF 预览图, 只有 MpoImageFile 才带 mpinfo
+    mp_entries = (getattr(img, 'mpinfo', None) or {}).get(0xB002, [])
+    frames = []
+    for frame, entry in enumerate(mp_entries):
+        if frame == 0 or 'Large Thumbnail' not in entry.get('Attribute', {}).get('MPType', ''):
+            continue
+        img.seek(frame)
+        if max(img.size) >= size:
+            frames.append((img.width * img.height, frame))
+    if frames:
+        img.seek(min(frames)[1])
+        preview = img.copy()
+        img.seek(0)
+        return preview
+    if mp_entries:
+        img.seek(0)
+
+    # EXIF IFD1 中的 JPEG 缩略图, 偏移量相对于 TIFF 头
+    raw_exif = img.info.get('exif')
+    if not raw_exif:
+        return None
+    ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+    offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+    if not offset or not length:
+        return None
+    tiff_start = 6 if raw_exif.startswith(b'Exif\x00\x00') else 0
+    data = raw_exif[tiff_start + offset:tiff_start + offset + length]
+    try:
+        thumbnail = Image.open(io.BytesIO(data))
+        if max(thumbnail.size) < size:
+            return None
+        thumbnail.load()
+        return thumbnail
+    except Exception as e:
+        logger.debug(f"_embedded_preview: 解析 IFD1 缩略图失败: {e}")
+        return None
+
+
+def get_preview(path: str, size: int = PREVIEW_SIZE) -> Image.Image:
+    """
+    获取用于界面预览的图片，长边不超过 size
+
+    优先使用内嵌预览图，没有合适的预览图时才解码原图：JPEG 通过 draft 按 DCT 缩放解码，
+    HEIC 由 pillow_heif 选用内嵌缩略图（旧版本 pillow_heif 会完整解码）
+
+    Args:
+        path: 照片路径
+        size: 预览图长边像素数
+
+    Returns:
+        已按 EXIF Orientation 摆正的预览图
+    """
+    with Image.open(path) as img:
+        preview = _embedded_preview(img, size)
+        if preview is not None:
+            orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+            method = _ORIENTATION_TRANSPOSE.get(orientation)
+            if method is not None:
+                preview = preview.transpose(method)
+        else:
+            img.draft('RGB', (size, size))
+            preview = ImageOps.exif_transpose(img)
+    preview.thumbnail((size, size))
+    return preview
+
+
+def get_preview_jpeg(path: str, size: int = PREVIEW_SIZE, quality: int = 85) -> io.BytesIO:
+    """获取预览图的 JPEG 字节流"""
+    preview = get_preview(path, size)
+    if preview.mode != 'RGB':
+        preview = preview.convert('RGB')
+
+    buffer = io.BytesIO()
+    preview.save(buffer, format='JPEG', quality=quality)
+    buffer.seek(0)
+    return buffer
+
+
 # ==================== 模板管理相关方法 ====================
 
 def get_template_path(template_name: str) -> Path:
@@ -175,15 +415,29 @@ def get_template(template_name: str) -> Template:
         template_name: 模板名称（不含扩展名），如 "standard1"
 
     Returns:
-        Jinja2 Template 对象，已注册 vh, vw, auto_logo 全局函数
+        Jinja2 Template 对象，已注册 vh, vw, auto_logo 全局函数，source_digest 为模板内容的摘要
     """
     template_path = get_template_path(template_name)
     with open(template_path, encoding='utf-8') as f:
         template_str = f.read()
+    return build_template(template_str)
+
+
+def build_template(template_str: str) -> Template:
+    """
+    将模板内容解析为 Jinja2 Template 对象, 用于尚未保存的模板（如编辑中的预览）
+
+    Args:
+        template_str: 模板内容
+
+    Returns:
+        Jinja2 Template 对象，已注册 vh, vw, auto_logo 全局函数，source_digest 为模板内容的摘要
+    """
     template = Template(template_str)
     template.globals['vh'] = vh
     template.globals['vw'] = vw
     template.globals['auto_logo'] = auto_logo
+    template.source_digest = hashlib.blake2b(template_str.encode('utf-8'), digest_size=16).hexdigest()
     return template
 
 
@@ -0,0 +1,402 @@
+"""
+监听模式
+
+监听输入文件夹中新增或修改的照片并自动处理。Linux 下使用 inotify, 其他平台退化为轮询文件的大小和 mtime
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+from core.batch import ProgressChannel
+from core.jobs import Job, JobScheduler
+from core.logger import logger
+from core.util import _cached_scan_dir
+from processor.core import ProcessCancelled
+
+# inotify 事件类型, 见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """基于 ctypes 的 inotify 封装"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._paths: dict[int, str] = {}
+
+    def add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {path}')
+        self._paths[wd] = path
+
+    def read_events(self, timeout: float) -> list[tuple[str, int]]:
+        """
+        等待最多 timeout 秒并读取事件
+
+        Returns:
+            [(完整路径, mask)], 队列溢出时路径为空字符串
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append(('', mask))
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            directory = self._paths.get(wd)
+            if directory is not None:
+                events.append((os.path.join(directory, name) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(threading.Thread):
+    """
+    监听文件夹, 文件写入完成后回调
+
+    文件在 debounce 秒内没有新的事件且大小、mtime 不再变化时, 才认为写入完成
+    """
+
+    def __init__(self, folder: str, suffixes: set[str], callback: Callable[[str], None],
+                 debounce: float = 2.0, interval: float = 1.0, exclude: list[str] = None,
+                 use_inotify: bool = True):
+        """
+        Args:
+            folder: 监听的文件夹
+            suffixes: 支持的文件后缀
+            callback: 文件写入完成后的回调, 参数为文件路径
+            debounce: 防抖时间（秒）
+            interval: 轮询间隔（秒）, inotify 模式下为检查防抖队列的间隔
+            exclude: 忽略的文件夹, 例如位于输入文件夹内的输出文件夹
+            use_inotify: 是否尝试使用 inotify
+        """
+        super().__init__(name='FolderWatcher', daemon=True)
+        self.folder = str(Path(folder).resolve())
+        self.suffixes = {s.lower() for s in suffixes}
+        self.callback = callback
+        self.debounce = debounce
+        self.interval = interval
+        self.exclude = [str(Path(p).resolve()) for p in exclude or []]
+        self.use_inotify = use_inotify
+        self.mode: Optional[str] = None
+        self._stop_event = threading.Event()
+        # 等待写入完成的文件: 路径 -> (截止时间, (size, mtime_ns))
+        self._pending: dict[str, tuple[float, tuple[int, int]]] = {}
+        # 轮询模式下每个文件夹上一次的扫描结果: 文件夹 -> {文件名: (size, mtime_ns)}
+        self._dir_files: dict[str, dict[str, tuple[int, int]]] = {}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        inotify = self._init_inotify() if self.use_inotify else None
+        self.mode = 'polling' if inotify is None else 'inotify'
+        logger.info(f"监听模式已启动: {self.folder}, 方式: {self.mode}")
+        if inotify is None:
+            self._poll(initial=True)
+
+        try:
+            while not self._stop_event.is_set():
+                if inotify is not None:
+                    self._handle_events(inotify, inotify.read_events(self.interval))
+                else:
+                    self._stop_event.wait(self.interval)
+                    self._poll()
+                self._flush_pending()
+        except Exception as e:
+            logger.error(f"监听模式异常退出: {e}")
+        finally:
+            if inotify is not None:
+                inotify.close()
+            logger.info(f"监听模式已停止: {self.folder}")
+
+    def _is_excluded(self, path: str) -> bool:
+        return any(path == p or path.startswith(p + os.sep) for p in self.exclude)
+
+    def _is_target(self, path: str) -> bool:
+        name = os.path.basename(path)
+        return (not name.startswith('.') and os.path.splitext(name)[1].lower() in self.suffixes
+                and not self._is_excluded(path))
+
+    def _iter_dirs(self, root: str, scan: Callable[[str], tuple] = _cached_scan_dir):
+        """遍历 root 及其子文件夹, 跳过隐藏文件夹、符号链接和 exclude; scan 返回单层目录的 (文件夹名列表, 文件)"""
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            if self._is_excluded(path):
+                continue
+            try:
+                dirs, files = scan(path)
+            except OSError as e:
+                logger.debug(f"FolderWatcher: 扫描失败 {path}: {e}")
+                continue
+            yield path, files
+            stack.extend(os.path.join(path, name) for name in dirs)
+
+    def _init_inotify(self) -> Optional[_Inotify]:
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError, TypeError) as e:
+            logger.info(f"inotify 不可用, 使用轮询模式: {e}")
+            return None
+        try:
+            for path, _ in self._iter_dirs(self.folder):
+                inotify.add_watch(path)
+        except OSError as e:
+            logger.warning(f"inotify 添加监听失败, 使用轮询模式: {e}")
+            inotify.close()
+            return None
+        return inotify
+
+    def _handle_events(self, inotify: _Inotify, events: list[tuple[str, int]]):
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify 事件队列溢出, 部分文件变化可能未被检测到")
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                    # 新文件夹: 添加监听, 并补上添加监听之前已经写入的文件
+                    for dir_path, files in self._iter_dirs(path):
+                        try:
+                            inotify.add_watch(dir_path)
+                        except OSError as e:
+                            logger.warning(f"inotify 添加监听失败 {dir_path}: {e}")
+                        for name, _ in files:
+                            self._touch(os.path.join(dir_path, name))
+            elif self._is_target(path):
+                self._touch(path)
+
+    def _scan_signatures(self, path: str) -> tuple[list[str], dict[str, tuple[int, int]]]:
+        """
+        不经过缓存扫描单层目录: 原地改写文件不会改变目录的 mtime, 只有逐个比较文件才能发现
+
+        Returns:
+            (文件夹名列表, {文件名: (size, mtime_ns)}), 只包含支持的文件
+        """
+        dirs, files = [], {}
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in self.suffixes and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return dirs, files
+
+    def _poll(self, initial: bool = False):
+        """轮询模式: 比较每个文件的大小和 mtime, 新增或修改的文件进入防抖队列"""
+        current = {}
+        for dir_path, files in self._iter_dirs(self.folder, self._scan_signatures):
+            current[dir_path] = files
+            if initial:
+                continue
+            previous = self._dir_files.get(dir_path, {})
+            for name, signature in files.items():
+                if previous.get(name) != signature:
+                    self._touch(os.path.join(dir_path, name))
+        self._dir_files = current
+
+    def _touch(self, path: str):
+        """记录文件变化, 推迟其截止时间"""
+        if not self._is_target(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        self._pending[path] = (time.monotonic() + self.debounce, (stat.st_size, stat.st_mtime_ns))
+
+    def _flush_pending(self):
+        """回调已经写入完成的文件"""
+        now = time.monotonic()
+        for path, (deadline, signature) in list(self._pending.items()):
+            if now < deadline:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._pending.pop(path, None)
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                # 仍在写入
+                self._pending[path] = (now + self.debounce, current)
+                continue
+            self._pending.pop(path, None)
+            try:
+                self.callback(path)
+            except Exception as e:
+                logger.error(f"监听模式回调失败 {path}: {e}")
+
+
+class WatchService:
+    """
+    监听模式服务: 检测到的文件作为单文件任务提交到共享的任务调度器, 与 API 提交的任务共用工作线程和内存预算,
+    进度通过 progress 广播
+    """
+
+    def __init__(self, handler: Callable[[str], tuple[bool, bool, Optional[str]]], scheduler: JobScheduler,
+                 estimate_memory: Callable[[str], int] = None):
+        """
+        Args:
+            handler: 处理单个文件, 返回 (success, skipped, error_message)
+            scheduler: 任务调度器
+            estimate_memory: 估算处理单个文件的内存峰值（字节）, 供调度器做准入控制
+        """
+        self.handler = handler
+        self.scheduler = scheduler
+        self.estimate_memory = estimate_memory
+        self.progress = ProgressChannel()
+        self._watcher: Optional[FolderWatcher] = None
+        # 已提交的任务: 文件路径 -> 任务, 停止时取消
+        self._jobs: dict[str, Job] = {}
+        # 已提交但尚未开始处理的文件
+        self._queued: set[str] = set()
+        # 正在处理的文件, 以及处理期间又发生了变化、结束后需要重新处理的文件
+        self._running: set[str] = set()
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+        self._counters = {'total': 0, 'processed': 0, 'success': 0, 'failure': 0, 'skipped': 0}
+
+    @property
+    def running(self) -> bool:
+        return self._watcher is not None and self._watcher.is_alive()
+
+    def start(self, folder: str, suffixes: set[str], exclude: list[str] = None, debounce: float = 2.0,
+              interval: float = 1.0):
+        with self._lock:
+            if self.running:
+                return
+            self._watcher = FolderWatcher(folder, suffixes, self._submit, debounce=debounce, interval=interval,
+                                          exclude=exclude)
+            self._watcher.start()
+
+    def stop(self):
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+            jobs = list(self._jobs.values())
+            self._queued.clear()
+            self._dirty.clear()
+        if watcher is not None:
+            watcher.stop()
+            watcher.join()
+        for job in jobs:
+            job.cancel()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'running': self.running,
+                'folder': self._watcher.folder if self._watcher else None,
+                'mode': self._watcher.mode if self._watcher else None,
+                'queued': len(self._queued),
+                **self._counters,
+            }
+
+    def _submit(self, path: str):
+        with self._lock:
+            if self._watcher is None:
+                return
+            if path in self._running:
+                # 正在处理的文件又被改写, 处理结束后重新处理
+                self._dirty.add(path)
+                return
+            if path in self._queued:
+                return
+            self._queued.add(path)
+            self._counters['total'] += 1
+            job = Job(f'watch-{uuid.uuid4().hex}', [path], self._run, None, estimate_memory=self.estimate_memory)
+            self._jobs[path] = job
+        # 监听模式的任务不进入调度器的任务列表, 不占用任务历史
+        self.scheduler.submit(job, track=False)
+
+    def _run(self, path: str):
+        file_name = os.path.basename(path)
+        with self._lock:
+            self._queued.discard(path)
+            self._running.add(path)
+        self._publish('progress', file_name, f'正在处理: {file_name}')
+        try:
+            success, skipped, error = self.handler(path)
+        except ProcessCancelled:
+            with self._lock:
+                self._running.discard(path)
+                self._jobs.pop(path, None)
+            raise
+        except Exception as e:
+            success, skipped, error = False, False, str(e)
+
+        with self._lock:
+            self._running.discard(path)
+            self._jobs.pop(path, None)
+            requeue = path in self._dirty
+            self._dirty.discard(path)
+            if skipped:
+                self._counters['skipped'] += 1
+                status = 'skipped'
+            elif success:
+                self._counters['success'] += 1
+                status = 'success'
+            else:
+                self._counters['failure'] += 1
+                status = 'failure'
+            self._counters['processed'] += 1
+
+        status_text = {'success': '完成', 'failure': '失败', 'skipped': '跳过'}[status]
+        self._publish('progress', file_name, f'{status_text}: {file_name}', status=status, error=error)
+        if requeue:
+            self._submit(path)
+        return success, skipped, error
+
+    def _publish(self, event: str, file_name: str, message: str, **extra):
+        with self._lock:
+            counters = dict(self._counters)
+        total = counters['total']
+        self.progress.publish(event, {
+            **counters,
+            'current': file_name,
+            'percent': round((counters['processed'] / total) * 100) if total > 0 else 0,
+            'message': message,
+            **extra,
+        })
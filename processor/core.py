@@ -1,25 +1,76 @@
+import copy
 import functools
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from collections import OrderedDict
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
 from enum import Enum
 from itertools import chain
 from typing import Dict, Any, Type, List, MutableMapping, Iterator, Optional
 
 from PIL import Image, ImageColor, ImageOps
 
-from core.configs import load_config
+from core.configs import ConfigSnapshot, config_snapshot
 from core.logger import logger
+from core.memory import memory_model, buffer_pixels, buffer_bytes
+from core.metrics import metrics, PROCESSOR_SECONDS, STAGE_SECONDS
+from core.snapshots import CaptureOptions, snapshot_writer
+from core.tracing import span
 from core.util import get_exif, log_rt
+from processor.tiling import TILE_THRESHOLD_PIXELS, TILE_ROWS, pipeline_slot
+
+
+class ProcessCancelled(Exception):
+    """处理被取消"""
+
+
+# 当前线程所处理任务的取消事件, 由任务调度器设置, start_process 在每个节点之间检查
+_cancel_event: ContextVar[Optional[threading.Event]] = ContextVar('cancel_event', default=None)
+
+
+def set_cancel_event(event: Optional[threading.Event]) -> Token:
+    """设置当前上下文的取消事件, 返回用于恢复的 Token"""
+    return _cancel_event.set(event)
+
+
+def reset_cancel_event(token: Token):
+    _cancel_event.reset(token)
+
+
+def check_cancelled():
+    """当前任务已被取消时抛出 ProcessCancelled"""
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise ProcessCancelled()
 
 
 class PipelineContext(MutableMapping):
     """管道上下文"""
 
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], params: Dict[tuple, Any] = None):
         self._config = config
+        # getcolor、getenum 的解析结果, 由编译后的管道计划提供, 使用同一计划的文件共享
+        self._params = params
+
+    def _resolve(self, key: tuple, resolve):
+        """按 key 缓存 resolve() 的结果, key 包含原始值, 值不可哈希时不缓存"""
+        if self._params is None:
+            return resolve()
+        try:
+            return self._params[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return resolve()
+        value = self._params[key] = resolve()
+        return value
 
     def get(self, key: str, default: Any = None) -> Any:
         return self._config.get(key) if key in self._config and self._config.get(key) is not None else default
@@ -28,7 +79,8 @@ class PipelineContext(MutableMapping):
         return self.get('exif')
 
     def getcolor(self, key: str, default: Any = None) -> Any:
-        return _parse_color(self._config.get(key, default))
+        value = self._config.get(key, default)
+        return self._resolve(('color', value), lambda: _parse_color(value))
 
     def getint(self, key: str, default: int = 0) -> int:
         return int(self.get(key, default))
@@ -44,32 +96,15 @@ class PipelineContext(MutableMapping):
         if isinstance(value, enum):
             return value
 
-        # 尝试通过 name 查找 (如 "RED" -> Color.RED)
-        if isinstance(value, str):
-            try:
-                return enum[value]
-            except KeyError:
-                pass
-            try:
-                return enum[value.upper()]
-            except KeyError:
-                pass
-
-        # 尝试通过 value 查找 (如 1 -> Color.RED)
-        try:
-            return enum(value)
-        except ValueError:
-            pass
-
-        # 都找不到，返回默认值
-        return default
+        return self._resolve(('enum', enum, value, default), lambda: _parse_enum(value, default, enum))
 
     def get_processor_name(self):
         return self.get("processor_name")
 
     def get_buffer(self) -> List[Image]:
         if not self.get("buffer_loaded", False) and self.get("buffer_path"):
-            self.set("buffer", [ImageOps.exif_transpose(Image.open(path)) for path in self.get("buffer_path")])
+            with metrics.timer(STAGE_SECONDS, stage='decode'), span('decode'):
+                self.set("buffer", [ImageOps.exif_transpose(Image.open(path)) for path in self.get("buffer_path")])
             self.set("buffer_loaded", True)
         return self.get("buffer", [])
 
@@ -80,6 +115,13 @@ class PipelineContext(MutableMapping):
         if not (force_save or self.get("save_buffer", False)):
             return self
         directory = self.get("output", "./tmp")
+        config = config_snapshot()
+        if config.getboolean('DEFAULT', 'debug_capture', fallback=False):
+            # 调试模式: 由后台线程写入, 缓冲区仍使用内存中的图像
+            options = CaptureOptions.from_config(config)
+            for img in self.get_buffer():
+                snapshot_writer.submit(directory, processor_name, img, options)
+            return self
         if not os.path.isdir(directory):
             os.makedirs(directory)
         buffer_path = []
@@ -125,6 +167,13 @@ class PipelineContext(MutableMapping):
 
 
 class ImageProcessor(ABC):
+    # 是否支持分条处理, 支持的处理器在 ctx 中有 tile_rows 时按条带处理
+    tileable: bool = False
+    # 是否读取输入文件的 exif, 读取的处理器输出与文件有关, 不能在批次内复用
+    uses_exif: bool = False
+    # 以像素为单位的参数及其默认值（None 表示没有默认值或默认值按图像尺寸计算）, 低分辨率预览时按比例缩放
+    pixel_params: Dict[str, Any] = {}
+
     @abstractmethod
     def process(self, ctx: PipelineContext):
         pass
@@ -150,13 +199,20 @@ class ImageProcessor(ABC):
         # 定义一个包装函数（切面逻辑）
         @functools.wraps(original_process)
         def wrapper(self, ctx: PipelineContext):
+            # 记录内存峰值, 用于校准内存预估
+            pixels = buffer_pixels(ctx.get("buffer"))
+            rss_before = memory_model.begin_measure(pixels)
             start_time = time.perf_counter()  # 使用高精度计时
             try:
                 # 执行原本的业务逻辑
-                return original_process(self, ctx)
+                with span(self.name(), 'processor'):
+                    return original_process(self, ctx)
             finally:
                 end_time = time.perf_counter()
+                if rss_before is not None:
+                    memory_model.end_measure(self.name(), pixels, rss_before, buffer_bytes(ctx.get("buffer")))
                 cost_ms = (end_time - start_time) * 1000
+                metrics.observe(PROCESSOR_SECONDS, end_time - start_time, processor=self.name())
                 # 打印日志
                 logger.debug(f"[monitor]processor#{self.name()} cost {cost_ms:.2f}ms")
 
@@ -191,6 +247,29 @@ class Direction(Enum):
     RADIAL = "radial"  # 径向
 
 
+def _parse_enum(value: Any, default: Any, enum: Type[Enum]) -> Any:
+    """按 name 或 value 查找枚举成员, 都找不到时返回 default"""
+    # 尝试通过 name 查找 (如 "RED" -> Color.RED)
+    if isinstance(value, str):
+        try:
+            return enum[value]
+        except KeyError:
+            pass
+        try:
+            return enum[value.upper()]
+        except KeyError:
+            pass
+
+    # 尝试通过 value 查找 (如 1 -> Color.RED)
+    try:
+        return enum(value)
+    except ValueError:
+        pass
+
+    # 都找不到，返回默认值
+    return default
+
+
 def _parse_color(color) -> tuple:
     """
     解析颜色为 RGBA 元组
@@ -263,7 +342,169 @@ def register_processor(key: str, processor_cls: Type['ImageProcessor']):
     logger.debug(f"Registered processor: {key} -> {processor_cls.__name__}")
 
 
-def start_process(data: List[dict], input_path: str = None, output_path: str = None, initial_buffer: List = None):
+def save_atomic(img: Image.Image, output_path: str, **params):
+    """
+    先写入同目录下的隐藏临时文件, 再重命名为 output_path, 避免中断时留下写了一半的输出文件
+
+    临时文件保留原扩展名, 以便 Pillow 推断保存格式
+    """
+    directory, filename = os.path.split(output_path)
+    stem, ext = os.path.splitext(filename)
+    tmp_path = os.path.join(directory, f".{stem}.{uuid.uuid4().hex[:8]}.tmp{ext}")
+    try:
+        with metrics.timer(STAGE_SECONDS, stage='encode'), span('encode'):
+            img.save(tmp_path, **params)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _node_inputs(node: PipelineContext, processor_instance: ImageProcessor, idx: int,
+                 last_merger_idx: int) -> tuple[List[int], int]:
+    """
+    节点的输入在所有输出中的下标, 以及更新后的 last_merger_idx
+
+    指定了 select 时使用 select; merger 合并上一个 merger 之后的所有输出; 其他节点使用前一个节点的输出
+    """
+    if 'select' in node:
+        return json.loads(node['select']), last_merger_idx
+    # 使用 category() 方法判断是否为 merger，避免导入 Merger 类
+    if processor_instance.category() != "merger":
+        return [idx], last_merger_idx
+    # 收集下标从上一个 merger 之后, 到当前 idx 为止的 buffer
+    return list(range(last_merger_idx + 1, idx + 1)), idx
+
+
+class HoistedNodes:
+    """
+    批次内与文件无关的节点及其输出
+
+    只保留被其他节点使用的输出（以及最后一个节点的输出）; 文件渲染后的配置与计算时不完全一致时不复用,
+    因此判断有误也不会影响处理结果
+    """
+
+    def __init__(self, configs: Dict[int, dict], outputs: Dict[int, List[Image.Image]]):
+        self.configs = configs
+        self.outputs = outputs
+
+    def __bool__(self):
+        return bool(self.configs)
+
+    def names(self) -> List[str]:
+        return [f"#{idx} {config.get('processor_name')}" for idx, config in sorted(self.configs.items())]
+
+    def match(self, data: List[dict]) -> Dict[int, List[Image.Image]]:
+        """data 中可以直接使用预先计算结果的节点及其输出, 输出是副本, 处理器可能原地修改输入图像"""
+        if any(idx >= len(data) or data[idx] != config for idx, config in self.configs.items()):
+            return {}
+        return {idx: [img.copy() for img in self.outputs.get(idx, [])] for idx in self.configs}
+
+
+def hoist_nodes(data: List[dict], invariant: set[int]) -> HoistedNodes:
+    """
+    预先计算批次内与文件无关的节点
+
+    节点与文件无关需要: 配置不随文件变化（invariant 中的下标）, 不读取 exif, 并且是生成器或者输入全部与文件无关
+
+    Args:
+        data: 渲染后的处理器配置列表
+        invariant: 配置不随文件变化的节点下标
+    """
+    configs = copy.deepcopy(data)
+    nodes = [PipelineContext(datum) for datum in copy.deepcopy(data)]
+    # 各输出是否与文件无关, 0 是输入文件
+    fixed = [False]
+    all_buffer = [[]]
+    # 被其他节点使用的输出
+    consumed = {len(nodes)}
+    last_merger_idx = -1
+
+    for idx, node in enumerate(nodes):
+        processor = get_processor(node.get_processor_name())
+        output = None
+        if processor is not None:
+            processor_instance: ImageProcessor = processor()
+            indexes, last_merger_idx = _node_inputs(node, processor_instance, idx, last_merger_idx)
+            consumed.update(indexes)
+            hoistable = (idx in invariant and not processor.uses_exif
+                         and (processor_instance.category() == "generator" or all(fixed[i] for i in indexes)))
+            if hoistable:
+                # 生成器不使用输入, 其输入可能与文件有关
+                node.update_buffer(list(chain.from_iterable(all_buffer[i] or [] for i in indexes)))
+                try:
+                    processor_instance.process(node)
+                    output = node.get_buffer()
+                except Exception as e:
+                    logger.warning(f"[hoist]processor#{processor_instance.name()} 预先计算失败: {e}")
+        fixed.append(output is not None)
+        all_buffer.append(output)
+
+    hoisted = [idx for idx in range(len(nodes)) if fixed[idx + 1]]
+    return HoistedNodes({idx: configs[idx] for idx in hoisted},
+                        {idx: all_buffer[idx + 1] for idx in hoisted if idx + 1 in consumed})
+
+
+def _scale_value(value: Any, factor: float) -> Any:
+    """缩放数值, 数字字符串和 JSON 数组字符串（如 offsets）保持原来的格式"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        scaled = int(round(value * factor))
+        # 正的尺寸缩放后至少为 1
+        return max(scaled, 1) if value > 0 else scaled
+    if isinstance(value, float):
+        return value * factor
+    if isinstance(value, list):
+        return [_scale_value(item, factor) for item in value]
+    if isinstance(value, str):
+        text = value.strip()
+        if text.startswith('['):
+            try:
+                return json.dumps(_scale_value(json.loads(text), factor))
+            except ValueError:
+                return value
+        try:
+            number = float(text)
+        except ValueError:
+            return value
+        return str(_scale_value(int(number) if number.is_integer() else number, factor))
+    return value
+
+
+def _scale_node(node: dict, reference: dict, factor: float, defaults: bool):
+    processor = get_processor(node.get('processor_name'))
+    if processor is not None:
+        for key, default in processor.pixel_params.items():
+            if key in node:
+                # 渲染结果随图像尺寸变化的参数（vw、vh 等）已经按预览尺寸计算
+                if node[key] == reference.get(key):
+                    node[key] = _scale_value(node[key], factor)
+            elif defaults and default is not None:
+                node[key] = _scale_value(default, factor)
+    # 嵌套的管道配置, 如 watermark 的 left_top; 不补充默认值, 由外层处理器决定
+    for key, value in node.items():
+        if isinstance(value, dict) and 'processor_name' in value and isinstance(reference.get(key), dict):
+            _scale_node(value, reference[key], factor, False)
+
+
+def scale_pixel_params(data: List[dict], reference: List[dict], factor: float):
+    """
+    按 factor 缩放 data 中各处理器以像素为单位的参数, 用于低分辨率预览
+
+    data 是按缩小后的图像尺寸渲染的模板, reference 是按原图尺寸渲染的模板:
+    两者相同的参数是模板中写定的像素值, 需要缩放; 不同的参数由 vw、vh 等计算得到, 已经是预览尺寸下的值。
+    未设置且有固定默认值的参数按缩放后的默认值补充
+    """
+    if len(data) != len(reference):
+        reference = [{}] * len(data)
+    for node, ref in zip(data, reference):
+        _scale_node(node, ref, factor, True)
+
+
+def start_process(data: List[dict], input_path: str = None, output_path: str = None, initial_buffer: List = None,
+                  hoisted: HoistedNodes = None, config: ConfigSnapshot = None):
     """
     执行处理管道
 
@@ -272,8 +513,137 @@ def start_process(data: List[dict], input_path: str = None, output_path: str = N
         input_path: 输入文件路径
         output_path: 输出文件路径
         initial_buffer: 初始图像缓冲区（可选，用于不从文件加载的情况）
+        hoisted: 批次内预先计算的节点, 配置一致时直接使用其输出
+        config: 保存输出时使用的配置, 默认使用当前的配置快照
+    """
+    # 只有处理文件的顶层管道参与分配并行线程, 文字等嵌套管道不计入
+    with span('start_process', 'pipeline', nodes=len(data)), pipeline_slot() if input_path else nullcontext():
+        return _run_pipeline(data, input_path, output_path, initial_buffer, hoisted, config)
+
+
+# 嵌套管道的结果缓存: 配置摘要 -> 输出图像, 按 LRU 淘汰, 同时限制条目数和图像总大小
+_SUB_PIPELINE_CACHE_SIZE = 256
+_SUB_PIPELINE_CACHE_BYTES = 64 * 1024 * 1024
+_sub_pipeline_cache: OrderedDict[str, Image.Image] = OrderedDict()
+_sub_pipeline_cache_bytes = 0
+_sub_pipeline_cache_lock = threading.Lock()
+
+
+def _image_bytes(img: Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
+
+
+def pipeline_digest(data: List[dict]) -> str:
+    """处理器配置的规范化摘要, 与键的顺序无关"""
+    text = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def clear_sub_pipeline_cache():
+    """清空嵌套管道的结果缓存, 供基准测试测量未命中缓存时的耗时"""
+    global _sub_pipeline_cache_bytes
+    with _sub_pipeline_cache_lock:
+        _sub_pipeline_cache.clear()
+        _sub_pipeline_cache_bytes = 0
+
+
+def start_process_cached(data: List[dict]) -> Image.Image:
+    """
+    执行不依赖输入文件的嵌套管道（如水印四角的文字）, 配置相同的管道在进程内只计算一次
+
+    返回缓存图像的副本, 调用方可以修改
     """
-    nodes = [PipelineContext(datum) for datum in data]
+    global _sub_pipeline_cache_bytes
+    # start_process 会在配置中写入 buffer 等字段, 先计算摘要
+    key = pipeline_digest(data)
+    with _sub_pipeline_cache_lock:
+        cached = _sub_pipeline_cache.get(key)
+        if cached is not None:
+            _sub_pipeline_cache.move_to_end(key)
+            return cached.copy()
+
+    result = start_process(data)
+    size = _image_bytes(result)
+    if size > _SUB_PIPELINE_CACHE_BYTES // 4:
+        return result
+    with _sub_pipeline_cache_lock:
+        if key not in _sub_pipeline_cache:
+            _sub_pipeline_cache[key] = result.copy()
+            _sub_pipeline_cache_bytes += size
+        while len(_sub_pipeline_cache) > _SUB_PIPELINE_CACHE_SIZE \
+                or _sub_pipeline_cache_bytes > _SUB_PIPELINE_CACHE_BYTES:
+            _, evicted = _sub_pipeline_cache.popitem(last=False)
+            _sub_pipeline_cache_bytes -= _image_bytes(evicted)
+    return result
+
+
+@dataclass(frozen=True)
+class PlanStep:
+    """管道中的一个节点: 处理器实例及其输入在所有输出中的下标"""
+    processor: ImageProcessor
+    inputs: tuple[int, ...]
+    # getcolor、getenum 的解析结果, 在执行时填充
+    params: Dict[tuple, Any] = field(default_factory=dict, compare=False)
+
+
+@dataclass(frozen=True)
+class PipelinePlan:
+    """编译后的处理管道, 与文件无关, 渲染结果相同的文件共用"""
+    steps: tuple[PlanStep, ...]
+
+
+def compile_pipeline(data: List[dict]) -> PipelinePlan:
+    """查找处理器并创建实例, 解析 select 和 merger 的输入范围"""
+    steps = []
+    last_merger_idx = -1
+    for idx, datum in enumerate(data):
+        node = PipelineContext(datum)
+        processor = get_processor(node.get_processor_name())
+        if processor is None:
+            raise RuntimeError(f"Processor '{node.get_processor_name()}' not found")
+        # 处理器没有状态, 实例可以在多个线程中共用
+        processor_instance: ImageProcessor = processor()
+        indexes, last_merger_idx = _node_inputs(node, processor_instance, idx, last_merger_idx)
+        steps.append(PlanStep(processor_instance, tuple(indexes)))
+    return PipelinePlan(tuple(steps))
+
+
+# 管道计划缓存: 配置摘要 -> 计划, 按 LRU 淘汰
+_PLAN_CACHE_SIZE = 256
+_plan_cache: OrderedDict[str, PipelinePlan] = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+def clear_plan_cache():
+    """清空管道计划缓存, 供基准测试测量包含编译的耗时"""
+    with _plan_cache_lock:
+        _plan_cache.clear()
+
+
+def get_plan(data: List[dict]) -> PipelinePlan:
+    """渲染后配置相同的管道只编译一次"""
+    key = pipeline_digest(data)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    plan = compile_pipeline(data)
+    with _plan_cache_lock:
+        plan = _plan_cache.setdefault(key, plan)
+        _plan_cache.move_to_end(key)
+        while len(_plan_cache) > _PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+
+def _run_pipeline(data: List[dict], input_path: str, output_path: str, initial_buffer: List,
+                  hoisted: Optional[HoistedNodes], config: Optional[ConfigSnapshot]):
+    # 在节点配置被修改之前计算摘要和比较
+    plan = get_plan(data)
+    reused = hoisted.match(data) if hoisted else {}
+    nodes = [PipelineContext(datum, step.params) for datum, step in zip(data, plan.steps)]
 
     # 设置初始 buffer
     if initial_buffer is not None:
@@ -293,37 +663,34 @@ def start_process(data: List[dict], input_path: str = None, output_path: str = N
     output = nodes[0].get_buffer()
 
     all_buffer = [output]
-    last_merger_idx = -1
-
-    for idx, node in enumerate(nodes):
-        processor = get_processor(node.get_processor_name())
-        if processor is None:
-            raise RuntimeError(f"Processor '{node.get_processor_name()}' not found")
-
-        processor_instance: ImageProcessor = processor()
-        if 'select' in node:
-            indexes = json.loads(node['select'])
-            flattened = list(chain.from_iterable([all_buffer[i] for i in indexes]))
-            node.update_buffer(flattened)
-        else:
-            # 使用 category() 方法判断是否为 merger，避免导入 Merger 类
-            if processor_instance.category() != "merger":
-                node.update_buffer(output)
-            else:
-                # 收集下标从上一个 merger 之后, 到当前 idx 为止的 buffer
-                buffers_to_merge = all_buffer[last_merger_idx + 1:idx + 1]
-
-                # 将数组的数组展平为数组
-                flattened = list(chain.from_iterable(buffers_to_merge))
-                node.update_buffer(flattened)
-                last_merger_idx = idx
 
+    for idx, (node, step) in enumerate(zip(nodes, plan.steps)):
+        # 协作式取消: 正在处理的文件在下一个节点开始前停止
+        check_cancelled()
+        processor_instance = step.processor
+        if idx in reused:
+            output = reused[idx]
+            node.update_buffer(output)
+            all_buffer.append(output)
+            continue
+        # 将数组的数组展平为数组
+        node.update_buffer(list(chain.from_iterable(all_buffer[i] for i in step.inputs)))
+
+        # 超大图像对支持分条的处理器启用分条处理, 模板中显式设置的 tile_rows 优先（0 表示不分条）
+        if processor_instance.tileable and "tile_rows" not in node \
+                and buffer_pixels(node.get("buffer")) >= TILE_THRESHOLD_PIXELS:
+            node.set("tile_rows", TILE_ROWS)
+            logger.debug(f"[planner]processor#{processor_instance.name()} tiled by {TILE_ROWS} rows")
         processor_instance.process(node)
         output = node.get_buffer()
         all_buffer.append(output)
 
     nodes[-1].save_buffer("final").success()
     if output_path is not None:
-        nodes[-1].get_buffer()[0].convert("RGB").save(output_path, quality=load_config().getint('DEFAULT', 'quality'), subsampling=load_config().getint('DEFAULT', 'subsampling'))
+        result = nodes[-1].get_buffer()[0]
+        # convert 在模式相同时也会复制整幅图像
+        config = config or config_snapshot()
+        save_atomic(result if result.mode == "RGB" else result.convert("RGB"), output_path,
+                    quality=config.getint('DEFAULT', 'quality'), subsampling=config.getint('DEFAULT', 'subsampling'))
         logger.success(f"Generated new image: {output_path}")
     return nodes[-1].get_buffer()[0]
@@ -7,7 +7,8 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFilter
 
 from core.util import get_exif
-from processor.core import ImageProcessor, PipelineContext, start_process, get_processor
+from processor.core import ImageProcessor, PipelineContext, start_process_cached, get_processor
+from processor.tiling import TILE_ROWS, band_rows, band_workers, gaussian_blur, map_bands, strips, tiled_resize
 from processor.types import Alignment
 
 
@@ -17,15 +18,16 @@ class FilterProcessor(ImageProcessor, ABC):
 
 
 class BlurFilter(FilterProcessor):
+    tileable = True
+    pixel_params = {'blur_radius': 5}
+
     def process(self, ctx: PipelineContext):
         radius = ctx.getint("blur_radius", 5)
+        tile_rows = ctx.getint("tile_rows", 0)
 
         buffer = []
         for img in ctx.get_buffer():
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            ret_img = img.filter(ImageFilter.GaussianBlur(radius=radius))
-            buffer.append(ret_img)
+            buffer.append(gaussian_blur(img, radius, tile_rows, mode="RGB"))
         ctx.update_buffer(buffer).save_buffer(self.name()).success()
 
     def name(self) -> str:
@@ -33,9 +35,13 @@ class BlurFilter(FilterProcessor):
 
 
 class ResizeFilter(FilterProcessor):
+    tileable = True
+    pixel_params = {'width': None, 'height': None}
+
     def process(self, ctx: PipelineContext):
         width, height = ctx.get("width"), ctx.get("height")
         scale = ctx.get("scale")
+        tile_rows = ctx.getint("tile_rows", 0)
 
         buffer = []
         for img in ctx.get_buffer():
@@ -53,7 +59,12 @@ class ResizeFilter(FilterProcessor):
                     return
                 target_size = (int(img.width * scale_f), int(img.height * scale_f))
 
-            ret_img = img.resize(target_size, resample=Image.Resampling.LANCZOS)
+            workers = band_workers(img.width * img.height)
+            if tile_rows or workers > 1:
+                rows = tile_rows or band_rows(target_size[1], workers)
+                ret_img = tiled_resize(img, target_size, Image.Resampling.LANCZOS, rows, workers)
+            else:
+                ret_img = img.resize(target_size, resample=Image.Resampling.LANCZOS)
             buffer.append(ret_img)
         ctx.update_buffer(buffer).save_buffer(self.name()).success()
 
@@ -80,6 +91,15 @@ class TrimFilter(FilterProcessor):
     def name(self) -> str:
         return "trim"
 
+    @staticmethod
+    def _to_array(image: Image.Image) -> np.ndarray:
+        """转为 (height, width, channels) 的 float32 数组"""
+        img_array = np.array(image, dtype=np.float32)
+        # 处理灰度图（2D → 3D）
+        if img_array.ndim == 2:
+            img_array = img_array[:, :, np.newaxis]
+        return img_array
+
     def _get_background_color(self, img_array: np.ndarray) -> np.ndarray:
         """取四角像素均值作为背景色"""
         corners = np.array([
@@ -90,33 +110,14 @@ class TrimFilter(FilterProcessor):
         ])
         return np.mean(corners, axis=0)
 
-    def _shrink_bbox(
-            self,
-            diff: np.ndarray,
-            threshold: float,
+    @staticmethod
+    def _bbox_from_exceeds(
+            col_exceeds: np.ndarray,
+            row_exceeds: np.ndarray,
             width: int,
             height: int
     ) -> Tuple[int, int, int, int]:
-        """
-        从四个方向向内收缩边界框
-
-        Args:
-            diff: 每个像素与背景的差异矩阵 shape: (height, width)
-            threshold: 差异阈值
-            width: 图像宽度
-            height: 图像高度
-
-        Returns:
-            (left, right, top, bottom) 收缩后的边界
-        """
-        # 判断每个像素是否超过阈值（与背景有明显差异）
-        exceeds = diff > threshold
-
-        # 统计每列是否存在超过阈值的像素
-        col_exceeds = np.any(exceeds, axis=0)  # shape: (width,)
-        # 统计每行是否存在超过阈值的像素
-        row_exceeds = np.any(exceeds, axis=1)  # shape: (height,)
-
+        """由每列、每行是否存在前景像素得到 (left, right, top, bottom)"""
         # 如果整张图都是背景（没有前景），返回原始边界
         if not np.any(col_exceeds):
             return 0, width, 0, height
@@ -140,22 +141,28 @@ class TrimFilter(FilterProcessor):
             trim_top: bool = True,
             trim_bottom: bool = True,
     ) -> Tuple[int, int, int, int]:
-        img_array = np.array(image, dtype=np.float32)
-
-        # 处理灰度图（2D → 3D）
-        if img_array.ndim == 2:
-            img_array = img_array[:, :, np.newaxis]
-
-        height, width, channels = img_array.shape
+        width, height = image.size
 
         # ===== 第一步：取四角像素均值作为背景色 =====
-        background_color = self._get_background_color(img_array)
-
-        # ===== 第二步：计算每个像素与背景的差异 =====
-        diff = np.sqrt(np.sum((img_array - background_color) ** 2, axis=-1))
+        corners = [[self._to_array(image.crop((x, y, x + 1, y + 1)))[0, 0] for x in (0, width - 1)]
+                   for y in (0, height - 1)]
+        background_color = self._get_background_color(np.array(corners))
+
+        # ===== 第二步：按条带计算每个像素与背景的差异, 只保留每行、每列是否超过阈值; 大图在线程池中并行 =====
+        def scan(y0, y1, _, __):
+            band = self._to_array(image.crop((0, y0, width, y1)))
+            diff = np.sqrt(np.sum((band - background_color) ** 2, axis=-1))
+            exceeds = diff > threshold
+            return np.any(exceeds, axis=0), np.any(exceeds, axis=1)
+
+        workers = band_workers(width * height)
+        bands = list(strips(height, min(band_rows(height, workers), TILE_ROWS)))
+        results = map_bands(scan, bands, workers)
+        col_exceeds = np.logical_or.reduce([col for col, _ in results])
+        row_exceeds = np.concatenate([row for _, row in results])
 
         # ===== 第三步：从四个方向向内扫描，收缩边界框 =====
-        left, right, top, bottom = self._shrink_bbox(diff, threshold, width, height)
+        left, right, top, bottom = self._bbox_from_exceeds(col_exceeds, row_exceeds, width, height)
 
         if not trim_left:
             left = 0
@@ -175,6 +182,7 @@ class TrimFilter(FilterProcessor):
 
 
 class MarginFilter(FilterProcessor):
+    pixel_params = {'left_margin': None, 'right_margin': None, 'top_margin': None, 'bottom_margin': None}
 
     def process(self, ctx: PipelineContext):
         left_margin = ctx.getint("left_margin", 0)
@@ -210,6 +218,8 @@ class MarginFilter(FilterProcessor):
 
 
 class MarginWithRatioFilter(FilterProcessor):
+    uses_exif = True
+
     ratio_pattern = re.compile('[0-9.]+:[0-9.]+')
     ratio_threshold = 0.01
 
@@ -245,6 +255,9 @@ class MarginWithRatioFilter(FilterProcessor):
 
 
 class WatermarkFilter(FilterProcessor):
+    pixel_params = {'delimiter_width': None, 'left_margin': None, 'right_margin': None, 'top_margin': None,
+                    'bottom_margin': None, 'middle_spacing': None, 'center_logo_height': None}
+
     def process(self, ctx: PipelineContext):
         img = ctx.get_buffer()[0]
         color = ctx.get("color", "white")
@@ -261,10 +274,11 @@ class WatermarkFilter(FilterProcessor):
             if "height" not in t_s:
                 t_s["height"] = int(bottom_margin * .3)
 
-        left_top = start_process([ctx.get("left_top")])
-        left_bottom = start_process([ctx.get("left_bottom")])
-        right_top = start_process([ctx.get("right_top")])
-        right_bottom = start_process([ctx.get("right_bottom")])
+        # 同一批次中镜头、参数等文字经常相同, 按配置缓存
+        left_top = start_process_cached([ctx.get("left_top")])
+        left_bottom = start_process_cached([ctx.get("left_bottom")])
+        right_top = start_process_cached([ctx.get("right_top")])
+        right_bottom = start_process_cached([ctx.get("right_bottom")])
 
         left_logo = Image.open(ctx.get("left_logo")).convert('RGBA') if ctx.get("left_logo") else None
         right_logo = Image.open(ctx.get("right_logo")).convert('RGBA') if ctx.get("right_logo") else None
@@ -368,6 +382,8 @@ class WatermarkFilter(FilterProcessor):
 
 
 class WatermarkWithTimestampFilter(FilterProcessor):
+    pixel_params = {'height': None}
+
     def process(self, ctx: PipelineContext):
         img = ctx.get_buffer()[0]
 
@@ -392,37 +408,44 @@ class WatermarkWithTimestampFilter(FilterProcessor):
 
 
 class RoundedCornerFilter(FilterProcessor):
+    pixel_params = {'border_radius': 10}
+
     def process(self, ctx: PipelineContext):
         # CSS风格: border-radius, 单位px
         radius = ctx.getint("border_radius", 10)
 
         buffer = []
         for img in ctx.get_buffer():
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-
-            width, height = img.size
-
-            # 创建圆角蒙版
-            mask = Image.new('L', (width, height), 0)
-            draw = ImageDraw.Draw(mask)
-
-            # 绘制圆角矩形
-            draw.rounded_rectangle([(0, 0), (width, height)], radius=radius, fill=255)
-
-            # 应用蒙版
-            output = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-            output.paste(img, (0, 0))
-            output.putalpha(mask)
-
+            # 直接转换为输出图像, 不再额外创建一份 RGBA 画布
+            output = img.convert('RGBA') if img.mode != 'RGBA' else img.copy()
+            output.putalpha(self._rounded_mask(output.size, radius))
             buffer.append(output)
         ctx.update_buffer(buffer).save_buffer(self.name()).success()
 
+    @staticmethod
+    def _rounded_mask(size: Tuple[int, int], radius: int) -> Image.Image:
+        """
+        圆角蒙版, 只在四个角的小块上绘制圆角矩形, 其余部分直接填充 255
+
+        各小块按整幅图像的坐标绘制同一个圆角矩形, 结果与在整幅蒙版上绘制一致
+        """
+        width, height = size
+        mask = Image.new('L', size, 255)
+        corner = max(radius, 0) + 2
+        for left in {0, max(0, width - corner)}:
+            for top in {0, max(0, height - corner)}:
+                patch = Image.new('L', (min(corner, width), min(corner, height)), 0)
+                ImageDraw.Draw(patch).rounded_rectangle([(-left, -top), (width - left, height - top)],
+                                                        radius=radius, fill=255)
+                mask.paste(patch, (left, top))
+        return mask
+
     def name(self) -> str:
         return "rounded_corner"
 
 
 class ShadowFilter(FilterProcessor):
+    pixel_params = {'shadow_radius': 30}
 
     def process(self, ctx: PipelineContext):
         shadow_color = ctx.getcolor("shadow_color", (0, 0, 0, 180))
@@ -448,7 +471,7 @@ class ShadowFilter(FilterProcessor):
             shadow_layer.putalpha(original_img.getchannel('A'))
             background.paste(shadow_layer, (padding, padding))
             # 2. 高斯模糊
-            shadow_blurred = background.filter(ImageFilter.GaussianBlur(shadow_radius))
+            shadow_blurred = gaussian_blur(background, shadow_radius)
             # 3. 关键：应用透明度衰减曲线，消除边缘残留
             shadow_blurred = self._apply_alpha_falloff(shadow_blurred, falloff)
             # 4. 合成原图
@@ -517,10 +540,8 @@ class ShadowFilter(FilterProcessor):
         公式: new_alpha = (alpha / 255) ^ gamma * 255
         gamma > 1 时，低透明度像素会被压制得更低，边缘更干净
         """
-        r, g, b, a = img.split()
-
-        # 转为 numpy 处理
-        alpha_array = np.array(a, dtype=np.float32) / 255.0
+        # Alpha 只有 256 种取值, 先计算查找表再逐像素映射, 不需要为整幅图像创建浮点数组
+        alpha_array = np.arange(256, dtype=np.float32) / 255.0
 
         # 应用幂函数（缓动曲线）
         alpha_array = np.power(alpha_array, gamma)
@@ -528,15 +549,15 @@ class ShadowFilter(FilterProcessor):
         # 可选：设置硬截断阈值，彻底消除极低透明度
         alpha_array[alpha_array < 0.01] = 0
 
-        # 转回 PIL
-        new_alpha = Image.fromarray((alpha_array * 255).astype(np.uint8), mode='L')
-        img.putalpha(new_alpha)
+        lut = (alpha_array * 255).astype(np.uint8).tolist()
+        img.putalpha(img.getchannel('A').point(lut))
         return img
 
     def name(self) -> str:
         return "shadow"
 
 class CropFilter(FilterProcessor):
+    pixel_params = {'width': None, 'height': None, 'offset': None}
 
     def process(self, ctx: PipelineContext):
         width = ctx.getint("width", 0)
@@ -1,6 +1,8 @@
 import os.path
 import sys
+import threading
 from abc import ABC
+from collections import OrderedDict
 from dataclasses import dataclass, asdict
 from enum import Enum
 from pathlib import Path
@@ -11,6 +13,7 @@ from PIL import ImageFont, Image, ImageDraw
 
 from core.configs import fonts_dir
 from processor.core import PipelineContext, ImageProcessor, Direction, _parse_color
+from processor.tiling import TILE_ROWS, band_rows, band_workers, map_bands, strips
 
 BASE_FONT_SIZE = 512
 
@@ -73,6 +76,7 @@ class Generator(ImageProcessor, ABC):
 
 
 class SolidColorGenerator(Generator):
+    pixel_params = {'width': None, 'height': None}
 
     def process(self, ctx: PipelineContext):
         width, height = ctx.getint("width"), ctx.getint("height")
@@ -121,6 +125,27 @@ EASING_FUNCTIONS = {
 
 
 # ============ NumPy 加速绘制 ============
+# 径向渐变按条带计算, 每个条带的临时数组约为每像素 10 字节
+RADIAL_BAND_ROWS = 256
+# 径向渐变的缓动查找表级数
+EASING_LUT_SIZE = 4096
+
+
+def _color_ramp(t: np.ndarray, start_rgba: tuple, end_rgba: tuple, method: InterpolateMethod) -> np.ndarray:
+    """一维进度 t 对应的颜色, 形状 (n, 4), uint8"""
+    easing_func = EASING_FUNCTIONS.get(method, _easing_linear)
+    # 向量化颜色插值
+    start = np.array(start_rgba, dtype=float)
+    end = np.array(end_rgba, dtype=float)
+    t = easing_func(t.astype(float))
+    return np.clip(start + (end - start) * t[:, np.newaxis], 0, 255).astype(np.uint8)
+
+
+def _linear_t(n: int) -> np.ndarray:
+    """0 到 1 之间均匀分布的 n 个进度值"""
+    return np.arange(n) / (n - 1) if n > 1 else np.zeros(n)
+
+
 def _draw_gradient_numpy(
         width: int,
         height: int,
@@ -129,46 +154,99 @@ def _draw_gradient_numpy(
         direction: Direction,
         method: InterpolateMethod = InterpolateMethod.LINEAR
 ) -> Image.Image:
-    """NumPy 加速的渐变绘制"""
-
-    x = np.arange(width)
-    y = np.arange(height)
-    xx, yy = np.meshgrid(x, y)
+    """
+    NumPy 加速的渐变绘制
 
-    # 计算进度 t
+    水平、垂直渐变只计算一行（列）颜色再扩展; 对角渐变的颜色只与 x + y 有关, 每一行是同一个一维颜色表的切片;
+    径向渐变按条带计算, 缓动和插值通过查找表完成, 与逐像素计算相比个别像素可能有 ±1 的差异
+    """
     if direction == Direction.HORIZONTAL:
-        t = xx / (width - 1) if width > 1 else np.zeros_like(xx, dtype=float)
-    elif direction == Direction.VERTICAL:
-        t = yy / (height - 1) if height > 1 else np.zeros_like(yy, dtype=float)
-    elif direction == Direction.DIAGONAL:
-        t = (xx + yy) / (width + height - 2) if (width + height) > 2 else np.zeros_like(xx, dtype=float)
-    elif direction == Direction.RADIAL:
+        row = _color_ramp(_linear_t(width), start_rgba, end_rgba, method)
+        return Image.fromarray(row[np.newaxis], mode='RGBA').resize((width, height), Image.Resampling.NEAREST)
+    if direction == Direction.VERTICAL:
+        column = _color_ramp(_linear_t(height), start_rgba, end_rgba, method)
+        return Image.fromarray(column[:, np.newaxis], mode='RGBA').resize((width, height), Image.Resampling.NEAREST)
+    if direction not in (Direction.DIAGONAL, Direction.RADIAL):
+        color = _color_ramp(np.zeros(1), start_rgba, end_rgba, method)[0]
+        return Image.new('RGBA', (width, height), tuple(int(c) for c in color))
+
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    workers = band_workers(width * height)
+
+    if direction == Direction.DIAGONAL:
+        colors = _color_ramp(_linear_t(width + height - 1), start_rgba, end_rgba, method)
+
+        def draw_band(y0, y1, _, __):
+            for y in range(y0, y1):
+                pixels[y] = colors[y:y + width]
+
+        rows = min(band_rows(height, workers), TILE_ROWS)
+    else:
+        lut = _color_ramp(np.linspace(0, 1, EASING_LUT_SIZE), start_rgba, end_rgba, method)
         cx, cy = width / 2, height / 2
-        dist = np.sqrt((xx - cx) ** 2 + (yy - cy) ** 2)
         max_dist = np.sqrt(cx ** 2 + cy ** 2)
-        t = np.clip(dist / max_dist, 0, 1)
-    else:
-        t = np.zeros((height, width), dtype=float)
+        scale = np.float32((EASING_LUT_SIZE - 1) / max_dist if max_dist > 0 else 0)
+        dx2 = ((np.arange(width) - cx) ** 2).astype(np.float32)
 
-    # 应用缓动函数
-    easing_func = EASING_FUNCTIONS.get(method, _easing_linear)
-    t = easing_func(t.astype(float))
+        def draw_band(y0, y1, _, __):
+            dy2 = ((np.arange(y0, y1) - cy) ** 2).astype(np.float32)
+            dist = dx2[np.newaxis, :] + dy2[:, np.newaxis]
+            np.sqrt(dist, out=dist)
+            dist *= scale
+            np.minimum(dist, EASING_LUT_SIZE - 1, out=dist)
+            np.rint(dist, out=dist)
+            pixels[y0:y1] = lut[dist.astype(np.uint16)]
 
-    # 向量化颜色插值
-    start = np.array(start_rgba, dtype=float)
-    end = np.array(end_rgba, dtype=float)
+        rows = min(band_rows(height, workers), RADIAL_BAND_ROWS)
 
-    # 扩展维度 (height, width) -> (height, width, 1)
-    t = t[:, :, np.newaxis]
+    map_bands(draw_band, list(strips(height, rows)), workers)
+    return Image.fromarray(pixels, mode='RGBA')
 
-    # 插值计算
-    pixels = start + (end - start) * t
-    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
 
-    return Image.fromarray(pixels, mode='RGBA')
+# 渐变结果缓存: (尺寸, 颜色, 方向, 缓动) -> 图像, 按 LRU 淘汰, 同时限制条目数和图像总大小
+_GRADIENT_CACHE_SIZE = 8
+_GRADIENT_CACHE_BYTES = 256 * 1024 * 1024
+_gradient_cache: OrderedDict[tuple, Image.Image] = OrderedDict()
+_gradient_cache_bytes = 0
+_gradient_cache_lock = threading.Lock()
+
+
+def clear_gradient_cache():
+    """清空渐变结果缓存, 供基准测试测量实际绘制的耗时"""
+    global _gradient_cache_bytes
+    with _gradient_cache_lock:
+        _gradient_cache.clear()
+        _gradient_cache_bytes = 0
+
+
+def draw_gradient(width: int, height: int, start_rgba: tuple, end_rgba: tuple, direction: Direction,
+                  method: InterpolateMethod = InterpolateMethod.LINEAR) -> Image.Image:
+    """带缓存的渐变绘制, 返回缓存图像的副本, 调用方可以修改"""
+    global _gradient_cache_bytes
+    key = (width, height, tuple(start_rgba), tuple(end_rgba), direction, method)
+    with _gradient_cache_lock:
+        cached = _gradient_cache.get(key)
+        if cached is not None:
+            _gradient_cache.move_to_end(key)
+            return cached.copy()
+
+    image = _draw_gradient_numpy(width, height, start_rgba, end_rgba, direction, method)
+    size = image.width * image.height * 4
+    if size > _GRADIENT_CACHE_BYTES // 2:
+        return image
+    with _gradient_cache_lock:
+        if key not in _gradient_cache:
+            _gradient_cache[key] = image.copy()
+            _gradient_cache_bytes += size
+        while len(_gradient_cache) > _GRADIENT_CACHE_SIZE or _gradient_cache_bytes > _GRADIENT_CACHE_BYTES:
+            _, evicted = _gradient_cache.popitem(last=False)
+            _gradient_cache_bytes -= evicted.width * evicted.height * 4
+    return image
 
 
 class GradientColorGenerator(Generator):
+    pixel_params = {'width': None, 'height': None}
+
     def process(self, ctx: PipelineContext):
         width, height = ctx.get("width"), ctx.get("height")
         start_color = ctx.get("start_color")
@@ -179,7 +257,7 @@ class GradientColorGenerator(Generator):
         start_rgba = _parse_color(start_color)
         end_rgba = _parse_color(end_color)
 
-        image = _draw_gradient_numpy(
+        image = draw_gradient(
             width, height,
             start_rgba, end_rgba,
             direction, method
@@ -192,6 +270,8 @@ class GradientColorGenerator(Generator):
 
 
 class RichTextGenerator(Generator):
+    pixel_params = {'height': 100}
+
     @staticmethod
     def generate(segment: TextSegment) -> Image.Image:
         font = load_font(segment.font_path)
@@ -233,6 +313,8 @@ class RichTextGenerator(Generator):
 
 
 class MultiRichTextGenerator(Generator):
+    pixel_params = {'height': 100, 'text_spacing': None}
+
     def process(self, ctx: PipelineContext):
         text_segments: List[TextSegment] = TextSegment.from_dicts(ctx.get("text_segments"))
         text_alignment = ctx.get("text_alignment")
@@ -27,6 +27,8 @@ class Merger(ImageProcessor, ABC):
 
 
 class AlignmentMerger(Merger):
+    pixel_params = {'offsets': None}
+
     def process(self, ctx: PipelineContext):
         buffer: List[Image] = ctx.get_buffer()
         horizontal_alignment = ctx.getenum("horizontal_alignment", Alignment.CENTER, Alignment)
@@ -73,6 +75,8 @@ class AlignmentMerger(Merger):
 
 
 class ConcatMerger(Merger):
+    pixel_params = {'spacing': 10}
+
     def process(self, ctx: PipelineContext):
         buffer = ctx.get_buffer()
         alignment = ctx.getenum("alignment", Alignment.BOTTOM, Alignment)
@@ -0,0 +1,161 @@
+"""
+分条处理
+
+超大图像（如拼接的全景图）按水平条带处理, 每次只为一个条带分配中间结果, 避免整幅图像的多个临时副本同时存在。
+只适用于局部或可分离的操作: 条带上下各多取 halo 行, 处理后只保留中间部分。
+
+条带之间相互独立, 可以在线程池中并行处理（Pillow 的滤镜、缩放和 NumPy 运算会释放 GIL）。
+线程数按当前同时处理的文件数分配, 避免与批处理的工作线程一起超额占用 CPU
+"""
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, TypeVar
+
+from PIL import Image, ImageFilter
+
+T = TypeVar('T')
+
+# 输入像素数超过该值时, start_process 对支持分条的处理器启用分条处理
+TILE_THRESHOLD_PIXELS = 64_000_000
+# 条带高度（行）
+TILE_ROWS = 1024
+# 像素数低于该值的图像不拆分并行处理, 线程调度的开销会超过收益
+PARALLEL_MIN_PIXELS = 4_000_000
+
+_cpu_count = os.cpu_count() or 1
+_band_executor: ThreadPoolExecutor = None
+_active_pipelines = 0
+_lock = threading.Lock()
+
+
+@contextmanager
+def pipeline_slot():
+    """标记一个正在处理的文件, band_workers 据此分配线程"""
+    global _active_pipelines
+    with _lock:
+        _active_pipelines += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _active_pipelines -= 1
+
+
+def band_workers(pixels: int) -> int:
+    """单幅图像可以使用的并行线程数: CPU 核数平均分给正在处理的文件"""
+    if pixels < PARALLEL_MIN_PIXELS:
+        return 1
+    with _lock:
+        active = max(_active_pipelines, 1)
+    return max(1, _cpu_count // active)
+
+
+def band_rows(height: int, workers: int) -> int:
+    """按线程数平均划分时的条带高度"""
+    return math.ceil(height / max(workers, 1)) if height > 0 else 1
+
+
+def map_bands(func: Callable[..., T], bands: list[tuple], workers: int) -> list[T]:
+    """对每个条带执行 func(*band), 按顺序返回结果; workers 为 1 时在当前线程执行"""
+    global _band_executor
+    if workers <= 1 or len(bands) <= 1:
+        return [func(*band) for band in bands]
+    with _lock:
+        if _band_executor is None:
+            _band_executor = ThreadPoolExecutor(max_workers=_cpu_count, thread_name_prefix='band')
+    return list(_band_executor.map(lambda band: func(*band), bands))
+
+
+def strips(height: int, rows: int, halo: int = 0) -> Iterator[tuple[int, int, int, int]]:
+    """
+    将 [0, height) 划分为条带
+
+    Returns:
+        (y0, y1, src_y0, src_y1): 条带 [y0, y1) 及其加上 halo 之后的源区域 [src_y0, src_y1)
+    """
+    rows = max(int(rows), 1)
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
+
+
+def tiled_map(img: Image.Image, func: Callable[[Image.Image], Image.Image], rows: int, halo: int = 0,
+              mode: str = None, workers: int = 1) -> Image.Image:
+    """
+    按条带对 img 执行 func, 输出尺寸与输入相同
+
+    Args:
+        img: 输入图像
+        func: 处理单个条带, 返回与条带尺寸相同的图像
+        rows: 条带高度
+        halo: func 在垂直方向上依赖的相邻行数
+        mode: 输出图像的模式, 默认与输入相同
+        workers: 并行线程数, 每批处理 workers 个条带, 内存占用随之增加
+    """
+    width, height = img.size
+    output = Image.new(mode or img.mode, img.size)
+
+    def process_strip(y0, y1, src_y0, src_y1):
+        return func(img.crop((0, src_y0, width, src_y1))).crop((0, y0 - src_y0, width, y1 - src_y0))
+
+    all_strips = list(strips(height, rows, halo))
+    for i in range(0, len(all_strips), workers):
+        batch = all_strips[i:i + workers]
+        for (y0, _, _, _), result in zip(batch, map_bands(process_strip, batch, workers)):
+            output.paste(result, (0, y0))
+    return output
+
+
+def tiled_resize(img: Image.Image, size: tuple[int, int], resample: int, rows: int, workers: int = 1) -> Image.Image:
+    """
+    按输出条带缩放, 每个条带只缩放对应的源区域, 中间结果的大小与条带成正比
+
+    Pillow 会读取源区域之外的相邻像素参与插值, 因此条带之间没有接缝; 与整幅缩放相比个别像素可能有 ±1 的舍入差异
+    """
+    width, height = img.size
+    out_width, out_height = size
+    output = Image.new(img.mode, size)
+
+    def resize_strip(y0, y1, _, __):
+        box = (0, y0 * height / out_height, width, y1 * height / out_height)
+        return img.resize((out_width, y1 - y0), resample=resample, box=box)
+
+    all_strips = list(strips(out_height, rows))
+    for i in range(0, len(all_strips), workers):
+        batch = all_strips[i:i + workers]
+        for (y0, _, _, _), result in zip(batch, map_bands(resize_strip, batch, workers)):
+            output.paste(result, (0, y0))
+    return output
+
+
+def gaussian_blur(img: Image.Image, radius: float, tile_rows: int = 0, mode: str = None) -> Image.Image:
+    """
+    高斯模糊, 大图按条带并行处理, tile_rows 不为 0 时按该高度分条以限制内存
+
+    Pillow 的高斯模糊由三次盒式模糊近似, 3 * radius + 3 行的 halo 可以保证与整幅处理的结果一致
+
+    Args:
+        img: 输入图像
+        radius: 模糊半径
+        tile_rows: 条带高度, 0 表示按并行线程数平均划分
+        mode: 模糊前转换为该模式（按条带转换）, 默认不转换
+    """
+    def blur(strip: Image.Image) -> Image.Image:
+        if mode is not None and strip.mode != mode:
+            strip = strip.convert(mode)
+        return strip.filter(ImageFilter.GaussianBlur(radius))
+
+    workers = band_workers(img.width * img.height)
+    if not tile_rows and workers == 1:
+        return blur(img)
+    rows = tile_rows or band_rows(img.height, workers)
+    return tiled_map(img, blur, rows, halo=math.ceil(3 * radius) + 3, mode=mode, workers=workers)
+
+
+def set_band_threads(threads: int):
+    """设置单个进程内条带并行可用的 CPU 数, 多进程处理时按进程数分配"""
+    global _cpu_count
+    _cpu_count = max(int(threads), 1)